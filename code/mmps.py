@@ -16,19 +16,69 @@
 
 
 import logging
-import re
 import hashlib
 import datetime
-from openai import OpenAI
-from langchain.chains import LLMChain, SimpleSequentialChain
-from langchain_core.prompts import PromptTemplate
-from concurrent.futures import ThreadPoolExecutor
-from tqdm import tqdm
+import time
+import asyncio
+import argparse
+import json
+import os
+import sys
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mmps_cache import ResponseCache
+from mmps_backends import (MergingBackend, ModelResponse, OpenAIBackend, UsageMeter, add_fake_arguments, estimate_tokens,
+                           expect_siblings, fake_backend_from_args)
+from mmps_governor import DEFAULT_LIMITS, GovernedBackend, add_governor_arguments, governor_from_args
+from mmps_stream import StdoutSink
+from mmps_controller import add_controller_arguments, controller_from_args
+from mmps_logging import add_logging_arguments, configure_logging, current_job, job_context
+from mmps_compact import add_compaction_arguments, compactor_from_args, count_tokens
+from mmps_pipeline import DEFAULT_PIPELINE, USER_PROMPT, Pipeline, load_pipeline
+from mmps_checkpoint import add_checkpoint_arguments, checkpoints_from_args
+from mmps_semantic import add_semantic_arguments, semantic_cache_from_args
+from mmps_scoring import SCORING_DEFAULTS, Scorer, add_scoring_arguments, expected_score, parse_scores, score_format, scorer_from_args
+from mmps_telemetry import add_telemetry_arguments, configure_telemetry, metrics, tracer
+from mmps_cost import (PRICES, Budget, BudgetExceeded, Ledger, add_cost_arguments, budget_from_args, call_cost,
+                       current_ledger, prices_from_args)
 
 API_KEY = "sk-"   # Replace with your actual API key
 
-# Initialize the OpenAI client with the API key
-client = OpenAI(api_key=API_KEY)
+# Default model backend; every pipeline entry point also accepts its own `backend`
+default_backend = OpenAIBackend(API_KEY)
+
+# Maximum number of requests the async pipeline keeps in flight at once (shared by all jobs on a loop)
+MAX_IN_FLIGHT = 16
+_semaphores = {}
+
+# Optional ResponseCache shared by every model call, enabled with --cache
+response_cache = None
+
+# Optional SemanticCache of past jobs looked up by prompt similarity, enabled with --semantic-cache
+semantic_cache = None
+
+# Optional CheckpointStore that every finished layer output is written to, enabled with --checkpoint-dir
+checkpoints = None
+
+# Optional Compactor that removes near-duplicate sentences from the layer 3-5 context and packs it to an
+# input budget, enabled with --compact
+compactor = None
+# Layers, models and schedule of the pipeline, from --pipeline or the built-in default
+pipeline = Pipeline(DEFAULT_PIPELINE)
+
+# How final answers are scored (--scoring, --tournament-size)
+scorer = Scorer()
+
+# Price table used for the cost of every call (--price) and the hard limits of every job (--max-job-*)
+prices = PRICES
+budget = Budget()
+
+# With --merge-siblings every iteration samples the layers that only use the user's prompt (layer 1 by
+# default) with the first iteration's temperature and max_tokens, so the identical calls of sibling
+# iterations can be merged into one request with n choices
+SHARED_KEYWORDS = False
 
 # Define the system message
 SYSTEM = "You are an expert in solving problems and analysis. Use pseudo code to describe functionality and logic to developer working in any computer languge."
@@ -36,148 +86,980 @@ SYSTEM = "You are an expert in solving problems and analysis. Use pseudo code to
 # Variable to control DEBUG logging
 DEBUG = True
 
-def setup_logging(user_prompt):
-    # Generate a unique log file name based on the SHA256 hash of the user prompt and current time and date
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    hash_object = hashlib.sha256((user_prompt + current_time).encode())
-    log_filename = f"job_{hash_object.hexdigest()}.log"
-    
-    # Set up logging to the unique log file
-    logging.basicConfig(
-        filename=log_filename, 
-        level=logging.DEBUG,
-        format='%(asctime)s - %(levelname)s - %(message)s'
-    )
+def setup_logging(user_prompt, job_id=None):
+    # Generate a unique job id based on the SHA256 hash of the user prompt and current time and date,
+    # unless the job already has one
+    if job_id is None:
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        hash_object = hashlib.sha256((user_prompt + current_time).encode())
+        job_id = hash_object.hexdigest()
+
+    # Records logged in this context (and in tasks and graph nodes started from it) go to job_<id>.log
+    configure_logging()
+    current_job.set(job_id)
     logging.info("Logging setup complete.")
-    logging.info(f"User prompt: {user_prompt}")
+    logging.info("User prompt: %s", user_prompt)
+    return job_id
+
+class MemoryEntry:
+    __slots__ = ("iteration", "layer", "text", "tokens", "duration")
+
+    def __init__(self, iteration, layer, text, tokens, duration=None):
+        self.iteration = iteration
+        self.layer = layer
+        self.text = text
+        self.tokens = tokens
+        self.duration = duration
+
+    def __repr__(self):
+        return f"MemoryEntry(iteration={self.iteration}, layer={self.layer}, tokens={self.tokens}, text={self.text[:40]!r})"
 
 class Memory:
-    def __init__(self):
-        self.layers = {1: [], 2: [], 3: [], 4: [], 5: []}
-    
-    def store(self, layer, data):
-        self.layers[layer].append(data)
-        logging.debug(f"Storing data in layer {layer}: {data}")
-    
-    def retrieve(self, layer):
-        data = self.layers[layer]
-        logging.debug(f"Retrieving data from layer {layer}: {data}")
-        return data
-
-def call_openai_model(messages, model="gpt-4o-mini", max_tokens=100, temperature=0.5):
-    logging.info(f"Calling model '{model}' with parameters: max_tokens={max_tokens}, temperature={temperature}")
-    completion = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=temperature
-    )
-    result = completion.choices[0].message.content.strip()
-    logging.info(f"Received response: {result}")
-    return result
+    # Layer outputs of one job keyed by (iteration, layer). The lock makes an instance safe to fill from
+    # scheduler threads or concurrent coroutines, and max_entries bounds it by dropping the oldest entries.
+    # Only sizes are logged, never the stored text. With a CheckpointStore, outputs stored with the
+    # parameters of their call are also written to the job's checkpoint file.
+    def __init__(self, job_id=None, max_entries=None, checkpoint=None):
+        self.job_id = job_id
+        self.max_entries = max_entries
+        self.checkpoint = checkpoint
+        self.entries = {}
+        self.lock = threading.Lock()
 
-def extract_keywords(user_prompt, temperature, max_tokens):
-    task_prompt = f"Given the user's input: '{user_prompt}', extract 5 keywords or phrases and provide a one-sentence description for each."
-    messages = [
-        {"role": "system", "content": SYSTEM},
-        {"role": "user", "content": task_prompt}
-    ]
-    return call_openai_model(messages, model="gpt-4o-mini", max_tokens=max_tokens, temperature=temperature)
+    def store(self, layer, data, iteration=0, tokens=None, duration=None, params=None):
+        entry = MemoryEntry(iteration, layer, data, estimate_tokens(data) if tokens is None else tokens, duration)
+        if self.checkpoint is not None and params is not None:
+            self.checkpoint.layer(self.job_id, iteration, layer, data, params, duration)
+        with self.lock:
+            self.entries.pop((iteration, layer), None)
+            self.entries[(iteration, layer)] = entry
+            if self.max_entries and len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        logging.debug("Stored layer %s of iteration %s for job %s (%s tokens)", layer, iteration, self.job_id, entry.tokens)
+        return entry
 
-def analyze_keywords(user_prompt, keywords, temperature, max_tokens):
-    task_prompt = f"User's input: '{user_prompt}'. Analyze each keyword: {keywords}. Explain how it relates to solving the problem."
-    messages = [
-        {"role": "system", "content": SYSTEM},
-        {"role": "user", "content": task_prompt}
-    ]
-    return call_openai_model(messages, model="gpt-4o-mini", max_tokens=max_tokens, temperature=temperature)
+    def get(self, iteration, layer):
+        with self.lock:
+            return self.entries.get((iteration, layer))
 
-def generate_keyword_pairs_correlation(user_prompt, analyses, temperature, max_tokens):
-    task_prompt = f"Based on user's input: '{user_prompt}', create pairs of keywords from the analyses: {analyses}. Explain how each pair relates to the problem."
-    messages = [
-        {"role": "system", "content": SYSTEM},
-        {"role": "user", "content": task_prompt}
-    ]
-    return call_openai_model(messages, model="gpt-4o-mini", max_tokens=max_tokens, temperature=temperature)
+    def retrieve(self, layer, iteration=None):
+        # Texts of a layer in iteration order, or of a single iteration
+        with self.lock:
+            entries = [entry for entry in self.entries.values()
+                       if entry.layer == layer and (iteration is None or entry.iteration == iteration)]
+        entries.sort(key=lambda entry: entry.iteration)
+        logging.debug("Retrieved %s entries of layer %s for job %s", len(entries), layer, self.job_id)
+        return [entry.text for entry in entries]
 
-def synthesize_pair_relations(user_prompt, correlations, temperature, max_tokens):
-    task_prompt = f"Taking into account the user's input: '{user_prompt}', synthesize and mix the following correlations into a unified explanation: {correlations}. Do not include any code just information how to solve problem."
-    messages = [
-        {"role": "system", "content": SYSTEM},
-        {"role": "user", "content": task_prompt}
-    ]
-    return call_openai_model(messages, model="gpt-4o-mini", max_tokens=max_tokens, temperature=temperature)
-
-def summarize_all(user_prompt, memory, temperature, max_tokens):
-    layer_3_answers = memory.retrieve(3)
-    layer_4_answers = memory.retrieve(4)
-    combined = ' '.join(layer_3_answers + layer_4_answers)
-    task_prompt = f"With the user's input in mind: '{user_prompt}', summarize the following information into a final, comprehensive response: {combined}. Do not include any code just information how to solve problem, remove duplicates."
-    messages = [
-        {"role": "system", "content": SYSTEM},
+    def iterations(self):
+        with self.lock:
+            return sorted({iteration for iteration, _ in self.entries})
+
+    def __len__(self):
+        return len(self.entries)
+
+def _cache_lookup(messages, model, max_tokens, temperature, options=None, policy=True):
+    # `policy` is a layer's caching policy: True follows the cache's own, False skips it and "sampled"
+    # caches even calls with temperature > 0. Only text is cached, so calls asking for logprobs always
+    # go to the backend.
+    if response_cache is None or not policy or (options and options.get("logprobs")):
+        return None, None
+    return response_cache.lookup(model, messages, max_tokens, temperature, options, sampled=policy == "sampled")
+
+def _cache_store(cache_key, result):
+    if response_cache is not None:
+        response_cache.store(cache_key, result)
+
+def _stream_usage(messages, result):
+    # Streams carry no usage, so estimate it locally
+    return sum(estimate_tokens(message["content"]) for message in messages), estimate_tokens(result)
+
+def _account(span, model, response=None, seconds=0.0):
+    # Adds a call to its span and to the ledger of the running job; a call without response was a cache hit
+    prompt_tokens = response.prompt_tokens if response else 0
+    completion_tokens = response.completion_tokens if response else 0
+    cost = call_cost(prices, model, prompt_tokens, completion_tokens) if response else 0.0
+    if response:
+        span.set(cost=round(cost, 8))
+    ledger = current_ledger.get()
+    if ledger is not None:
+        layer = span.attributes.get("layer")
+        if isinstance(layer, int):
+            layer = pipeline.layers[layer - 1].name
+        ledger.add(model, prompt_tokens, completion_tokens, cost, seconds, layer, span.attributes.get("iteration"),
+                   cached=response is None)
+
+def _check_budget():
+    ledger = current_ledger.get()
+    if ledger is not None:
+        ledger.check()
+
+def call_openai_model(messages, model="gpt-4o-mini", max_tokens=100, temperature=0.5, backend=None, on_token=None,
+                      raw=False, cache=True, **options):
+    # With on_token the completion is streamed and every text delta is passed to it as it arrives.
+    # `options` are passed on to the API (response_format, logprobs); raw returns the whole ModelResponse.
+    logging.info("Calling model '%s' with parameters: max_tokens=%s, temperature=%s", model, max_tokens, temperature)
+    backend = backend or default_backend
+    with tracer.span("model_call", model=model, temperature=temperature, max_tokens=max_tokens) as span:
+        cache_key, result = _cache_lookup(messages, model, max_tokens, temperature, options, cache)
+        if result is not None:
+            logging.info("Cached response: %s", result)
+            span.set(cache_hit=True)
+            _account(span, model)
+            if on_token:
+                on_token(result)
+            return ModelResponse(result, model) if raw else result
+        _check_budget()
+        started = time.perf_counter()
+        if on_token and hasattr(backend, "stream"):
+            chunks = []
+            for delta in backend.stream(messages, model, max_tokens, temperature):
+                chunks.append(delta)
+                on_token(delta)
+            result = "".join(chunks).strip()
+            response = ModelResponse(result, model, *_stream_usage(messages, result))
+        else:
+            response = backend.complete(messages, model, max_tokens, temperature, **options)
+            result = response.text
+            if on_token:
+                on_token(result)
+        span.set(cache_hit=False, prompt_tokens=response.prompt_tokens, completion_tokens=response.completion_tokens)
+        _account(span, model, response, time.perf_counter() - started)
+    logging.info("Received response: %s", result)
+    _cache_store(cache_key, result)
+    return response if raw else result
+
+def _get_semaphore():
+    # asyncio primitives are bound to the loop they are first used on, so keep one per loop
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores.clear()
+        _semaphores[loop] = asyncio.Semaphore(MAX_IN_FLIGHT)
+    return _semaphores[loop]
+
+async def acall_openai_model(messages, model="gpt-4o-mini", max_tokens=100, temperature=0.5, backend=None, on_token=None,
+                             raw=False, cache=True, **options):
+    backend = backend or default_backend
+    with tracer.span("model_call", model=model, temperature=temperature, max_tokens=max_tokens) as span:
+        cache_key, result = _cache_lookup(messages, model, max_tokens, temperature, options, cache)
+        if result is not None:
+            logging.info("Cached response: %s", result)
+            span.set(cache_hit=True)
+            _account(span, model)
+            if on_token:
+                on_token(result)
+            return ModelResponse(result, model) if raw else result
+        queued = time.perf_counter()
+        async with _get_semaphore():
+            span.set(queue_seconds=round(time.perf_counter() - queued, 6))
+            _check_budget()
+            started = time.perf_counter()
+            logging.info("Calling model '%s' with parameters: max_tokens=%s, temperature=%s", model, max_tokens, temperature)
+            if on_token and hasattr(backend, "astream"):
+                chunks = []
+                async for delta in backend.astream(messages, model, max_tokens, temperature):
+                    chunks.append(delta)
+                    on_token(delta)
+                result = "".join(chunks).strip()
+                response = ModelResponse(result, model, *_stream_usage(messages, result))
+            else:
+                response = await backend.acomplete(messages, model, max_tokens, temperature, **options)
+                result = response.text
+                if on_token:
+                    on_token(result)
+            seconds = time.perf_counter() - started
+        span.set(cache_hit=False, prompt_tokens=response.prompt_tokens, completion_tokens=response.completion_tokens)
+        _account(span, model, response, seconds)
+    logging.info("Received response: %s", result)
+    _cache_store(cache_key, result)
+    return response if raw else result
+
+def build_messages(task_prompt, system=None):
+    return [
+        {"role": "system", "content": system or SYSTEM},
         {"role": "user", "content": task_prompt}
     ]
-    return call_openai_model(messages, model="gpt-4o", max_tokens=max_tokens, temperature=temperature)
 
-def gpt4o_score(user_prompt, responses):
+def build_layer_messages(layer, user_prompt, inputs):
+    if layer.compact:
+        inputs = compact_context(layer, user_prompt, inputs)
+    values = dict(zip(layer.inputs, inputs))
+    values[USER_PROMPT] = user_prompt
+    return build_messages(layer.prompt.render(values), pipeline.system)
+
+def compact_context(layer, user_prompt, texts):
+    # The system message, the user's prompt and the instructions count against the budget but are kept verbatim
+    if compactor is None:
+        return texts
+    values = dict.fromkeys(layer.inputs, "")
+    values[USER_PROMPT] = user_prompt
+    fixed = (pipeline.system or SYSTEM) + layer.prompt.render(values)
+    return compactor.pack(texts, reserved=count_tokens(fixed))
+
+SCORE_AS_JSON = "Give every response its score as JSON, one entry with its number and score per response."
+SCORE_AS_TOKEN = "Output only the score, a single number from 1 to 10, nothing more."
+
+def scoring_prompt(user_prompt, responses, instruction=SCORE_AS_JSON):
     combined_responses = "\n".join([f"Response {i+1}: {response}" for i, response in enumerate(responses)])
-    scoring_prompt = (f"Use scoring technique from 1-10 (Output only score nothing more just numeric value without any comments and additional information - use csv to show rate of response in order like in this prompt) to get best answer related (best value to solve the user's problem in proposed way) with user's prompt. "
-                      f"Evaluate the following responses:\n\nUser's input: '{user_prompt}'\n\n{combined_responses}")
-    messages = [
-        {"role": "system", "content": SYSTEM},
-        {"role": "user", "content": scoring_prompt}
-    ]
-    logging.info(f"Scoring prompt: {scoring_prompt}")
-    score_response = call_openai_model(messages, model="gpt-4o", max_tokens=20, temperature=0.0)
-    logging.info(f"Model output (scoring): {score_response}")
-    try:
-        scores = [float(score) for score in re.findall(r'\b\d+\b', score_response)]
-        if any(score < 1 or score > 10 for score in scores):
-            raise ValueError("Score out of range")
-    except (ValueError, IndexError):
-        scores = [0] * len(responses)
+    return (f"Use scoring technique from 1-10 to rate each response by its value for solving the user's problem in the proposed way. {instruction} "
+            f"Evaluate the following responses:\n\nUser's input: '{user_prompt}'\n\n{combined_responses}")
+
+def pick_best(responses, scores):
+    # Responses that got no valid score count as 0, so they only win when nothing could be scored
+    scores = [0 if score is None else score for score in scores]
     scores_csv = ','.join(str(score) for score in scores)
-    logging.info(f"Scores in CSV format: {scores_csv}")
-    best_response, best_score = sorted(zip(responses, scores), key=lambda x: x[1], reverse=True)[0]
-    logging.debug(f"Best scored response: {best_response} with score: {best_score}")
-    return best_response, best_score
+    logging.info("Scores in CSV format: %s", scores_csv)
+    best = max(range(len(responses)), key=lambda i: scores[i])
+    logging.debug("Best scored response: %s with score: %s", responses[best], scores[best])
+    return responses[best], scores[best]
 
-def main():
-    user_prompt = input("Enter your main prompt: ")
-    setup_logging(user_prompt)
-    logging.debug(f"Received user prompt: {user_prompt}")
-    memory = Memory()
-
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        for i in tqdm(range(3), desc="Processing", disable=not DEBUG):  # Perform the loop 3 times
-            temperature = 0.3 + i * 0.2
-            max_tokens = 100 + i * 200
-            final_tokens = 2000
-            logging.info(f"Step {i+1}: Extracting keywords with temperature {temperature} and max_tokens {max_tokens}")
-            futures.append(executor.submit(extract_keywords, user_prompt, temperature, max_tokens))
-            logging.info(f"Step {i+1}: Analyzing keywords")
-            futures.append(executor.submit(analyze_keywords, user_prompt, futures[-1].result(), temperature, max_tokens))
-            logging.info(f"Step {i+1}: Generating keyword pairs correlation")
-            futures.append(executor.submit(generate_keyword_pairs_correlation, user_prompt, futures[-1].result(), temperature, max_tokens))
-            logging.info(f"Step {i+1}: Synthesizing pair relations")
-            futures.append(executor.submit(synthesize_pair_relations, user_prompt, futures[-1].result(), temperature, max_tokens))
-            logging.info(f"Step {i+1}: Summarizing all information")
-            futures.append(executor.submit(summarize_all, user_prompt, memory, temperature, final_tokens))
-
-        for future in futures:
-            result = future.result()
-            memory.store(futures.index(future) % 5 + 1, result)
-
-    # Use GPT-4o to score the final responses
-    final_answers = memory.retrieve(5)
-    logging.info("Scoring final responses")
-    best_answer, best_score = gpt4o_score(user_prompt, final_answers)
+def _score_request(user_prompt, responses):
+    if scorer.mode == "logprobs":
+        prompt = scoring_prompt(user_prompt, responses, SCORE_AS_TOKEN)
+        return build_messages(prompt), {"max_tokens": 2, "raw": True, "logprobs": True, "top_logprobs": 10}
+    prompt = scoring_prompt(user_prompt, responses)
+    return build_messages(prompt), {"max_tokens": 16 * len(responses) + 16, "response_format": score_format(len(responses))}
+
+def _parse_score_response(result, count):
+    if scorer.mode == "logprobs":
+        score = expected_score(result.logprobs)
+        return [score] if score is not None else parse_scores(result.text, 1)
+    logging.info("Model output (scoring): %s", result)
+    return parse_scores(result, count)
+
+def _in_threads(func, items):
+    # Runs func over items in parallel, each call in a copy of the caller's context (job id, span)
+    with ThreadPoolExecutor(max_workers=min(len(items), 8)) as executor:
+        return list(executor.map(lambda call: call[0].run(func, call[1]),
+                                 [(contextvars.copy_context(), item) for item in items]))
+
+def score_group(user_prompt, responses, backend=None):
+    # One score per response (None if it could not be scored). In logprobs mode every response is a call
+    # of its own; in JSON mode responses missing from the output are scored again one by one.
+    if scorer.mode == "logprobs" and len(responses) > 1:
+        return [scores[0] for scores in _in_threads(lambda r: score_group(user_prompt, [r], backend), responses)]
+    messages, options = _score_request(user_prompt, responses)
+    result = call_openai_model(messages, model=scorer.model, temperature=0.0, backend=backend, **options)
+    scores = _parse_score_response(result, len(responses))
+    missing = [i for i, score in enumerate(scores) if score is None]
+    if missing and len(responses) > 1:
+        logging.warning("No valid score for responses %s, scoring them one by one", [i + 1 for i in missing])
+        for i, rescored in zip(missing, _in_threads(lambda i: score_group(user_prompt, [responses[i]], backend)[0], missing)):
+            scores[i] = rescored
+    return scores
+
+def tournament_round(indices, scored_groups):
+    # The best responses of every scored group, by index into the whole pool
+    winners = [index for group, scores in zip(scorer.groups(indices), scored_groups)
+               for index in scorer.winners(group, scores)]
+    logging.info("Tournament round: %s of %s responses advance", len(winners), len(indices))
+    return winners
+
+def run_layer(layer, user_prompt, inputs, temperature, max_tokens, backend=None, stream=None, iteration=0):
+    # `stream` receives token(iteration, delta) while the answer is generated and finished(iteration, text) at the end
+    messages = build_layer_messages(layer, user_prompt, inputs)
+    on_token = functools.partial(stream.token, iteration) if stream else None
+    token = expect_siblings.set(shares_calls(layer))
+    try:
+        with layer.limit():
+            result = call_openai_model(messages, model=layer.model, max_tokens=max_tokens, temperature=temperature,
+                                       backend=backend, on_token=on_token, cache=layer.cache)
+    finally:
+        expect_siblings.reset(token)
+    if stream:
+        stream.finished(iteration, result)
+    return result
+
+def gpt4o_score(user_prompt, responses, backend=None):
+    indices = list(range(len(responses)))
+    while len(indices) > scorer.group_size:
+        groups = [[responses[i] for i in group] for group in scorer.groups(indices)]
+        scored_groups = _in_threads(lambda group: score_group(user_prompt, group, backend), groups)
+        indices = tournament_round(indices, scored_groups)
+    finalists = [responses[i] for i in indices]
+    return pick_best(finalists, score_group(user_prompt, finalists, backend))
+
+async def arun_layer(layer, user_prompt, inputs, temperature, max_tokens, backend=None, stream=None, iteration=0):
+    messages = build_layer_messages(layer, user_prompt, inputs)
+    on_token = functools.partial(stream.token, iteration) if stream else None
+    token = expect_siblings.set(shares_calls(layer))
+    try:
+        async with layer.alimit():
+            result = await acall_openai_model(messages, model=layer.model, max_tokens=max_tokens,
+                                              temperature=temperature, backend=backend, on_token=on_token,
+                                              cache=layer.cache)
+    finally:
+        expect_siblings.reset(token)
+    if stream:
+        stream.finished(iteration, result)
+    return result
+
+async def gather_or_cancel(awaitables):
+    # asyncio.gather that cancels the others and waits for them to end as soon as one fails (or the caller
+    # is cancelled), so that no sibling keeps making calls for a job that already failed
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def ascore_group(user_prompt, responses, backend=None):
+    if scorer.mode == "logprobs" and len(responses) > 1:
+        return [scores[0] for scores in await gather_or_cancel(ascore_group(user_prompt, [r], backend) for r in responses)]
+    messages, options = _score_request(user_prompt, responses)
+    result = await acall_openai_model(messages, model=scorer.model, temperature=0.0, backend=backend, **options)
+    scores = _parse_score_response(result, len(responses))
+    missing = [i for i, score in enumerate(scores) if score is None]
+    if missing and len(responses) > 1:
+        logging.warning("No valid score for responses %s, scoring them one by one", [i + 1 for i in missing])
+        rescored = await gather_or_cancel(ascore_group(user_prompt, [responses[i]], backend) for i in missing)
+        for i, score in zip(missing, rescored):
+            scores[i] = score[0]
+    return scores
+
+async def agpt4o_score(user_prompt, responses, backend=None):
+    indices = list(range(len(responses)))
+    while len(indices) > scorer.group_size:
+        groups = [[responses[i] for i in group] for group in scorer.groups(indices)]
+        scored_groups = await gather_or_cancel(ascore_group(user_prompt, group, backend) for group in groups)
+        indices = tournament_round(indices, scored_groups)
+    finalists = [responses[i] for i in indices]
+    return pick_best(finalists, await ascore_group(user_prompt, finalists, backend))
+
+def node_attributes(name):
+    # Span attributes of a graph node: (iteration, layer) for layer nodes, (iteration, "score") or "score"
+    if isinstance(name, tuple):
+        return {"iteration": name[0], "layer": name[1]}
+    return {"layer": name}
+
+class Ref:
+    # Placeholder for the result of another graph node, resolved when the node runs
+    def __init__(self, name):
+        self.name = name
+
+class TaskGraph:
+    # Small dependency-graph scheduler: every node declares the nodes it consumes (as Ref
+    # arguments) and is submitted to the executor as soon as all of them have finished.
+    def __init__(self):
+        self.nodes = {}
+        self.results = {}
+        self.timings = {}
+
+    def add(self, name, func, *args, **kwargs):
+        deps = []
+        for arg in args:
+            items = arg if isinstance(arg, list) else [arg]
+            deps.extend(item.name for item in items if isinstance(item, Ref))
+        self.nodes[name] = (func, args, kwargs, deps)
+        return Ref(name)
+
+    def _resolve(self, arg):
+        if isinstance(arg, Ref):
+            return self.results[arg.name]
+        if isinstance(arg, list):
+            return [self._resolve(item) for item in arg]
+        return arg
+
+    def _timed(self, name, func, args, kwargs):
+        start = time.perf_counter()
+        try:
+            with tracer.span("layer", **node_attributes(name)):
+                return func(*args, **kwargs)
+        finally:
+            self.timings[name] = (start, time.perf_counter())
+
+    def run(self, executor, on_done=None):
+        pending = dict(self.nodes)
+        running = {}
+        while pending or running:
+            ready = [name for name, node in pending.items() if all(dep in self.results for dep in node[3])]
+            for name in ready:
+                func, args, kwargs, _ = pending.pop(name)
+                args = [self._resolve(arg) for arg in args]
+                # Worker threads do not inherit context variables such as the job id used for logging
+                context = contextvars.copy_context()
+                running[executor.submit(context.run, self._timed, name, func, args, kwargs)] = name
+            if not running:
+                raise ValueError(f"Unresolvable dependencies for nodes: {list(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                self.results[name] = future.result()
+                logging.info("Node %s finished in %.2fs", name, self.duration(name))
+                if on_done:
+                    on_done(name, self.results[name])
+        return self.results
+
+    def duration(self, name):
+        start, end = self.timings[name]
+        return end - start
+
+    def critical_path(self):
+        # Walk back from the last node to finish, always following the dependency that finished last
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while self.nodes[name][3]:
+            name = max(self.nodes[name][3], key=lambda n: self.timings[n][1])
+            path.append(name)
+        return [(name, self.duration(name)) for name in reversed(path)]
+
+def shares_calls(layer):
+    # Whether every iteration sends this layer the same request, so that --merge-siblings waits for them
+    return SHARED_KEYWORDS and layer.independent
+
+def shared_params(layer, schedule, temperature, max_tokens):
+    if shares_calls(layer):
+        return pipeline.layer_params(layer, *schedule(0))
+    return temperature, max_tokens
+
+def iteration_schedule(i, max_tokens_start=None, max_tokens_step=None, final_tokens=None):
+    # (temperature, max_tokens, final_tokens) of iteration i from the pipeline's schedule
+    return pipeline.schedule(i, max_tokens_start, max_tokens_step, final_tokens)
+
+def best_scored(scored):
+    # Picks the best (response, score) pair of candidates that were scored one by one
+    return max(scored, key=lambda x: x[1])
+
+def build_pipeline(graph, user_prompt, iterations=3, backend=None, schedule=iteration_schedule, stream=None,
+                   score_early=False):
+    # Compiles the pipeline into graph nodes (iteration, layer number). With score_early every candidate is
+    # scored on its own as soon as it is finished, instead of all candidates together after the slowest iteration
+    final_answers = []
+    for i in range(iterations):
+        temperature, max_tokens, final_tokens = schedule(i)
+        logging.info("Step %s: Scheduling layers with temperature %s and max_tokens %s", i+1, temperature, max_tokens)
+        outputs = {}
+        for number, layer in enumerate(pipeline.layers, 1):
+            layer_temperature, layer_tokens = shared_params(
+                layer, schedule, *pipeline.layer_params(layer, temperature, max_tokens, final_tokens))
+            answer = layer is pipeline.answer
+            outputs[layer.name] = graph.add((i, number), run_layer, layer, user_prompt,
+                                            [outputs[name] for name in layer.inputs], layer_temperature, layer_tokens,
+                                            backend=backend, stream=stream if answer else None, iteration=i)
+        final_answer = outputs[pipeline.answer.name]
+        if score_early:
+            final_answer = graph.add((i, "score"), gpt4o_score, user_prompt, [final_answer], backend=backend)
+        final_answers.append(final_answer)
+    if score_early:
+        return graph.add("score", best_scored, final_answers)
+    return graph.add("score", gpt4o_score, user_prompt, final_answers, backend=backend)
+
+async def _timed(coro, timings, **attributes):
+    start = time.perf_counter()
+    with tracer.span("layer", **attributes):
+        result = await coro
+    timings.append(round(time.perf_counter() - start, 3))
+    return result
+
+def offer_candidate(iteration, answer, score=None):
+    # Keeps a finished answer, so that a job that runs out of budget can still return it
+    ledger = current_ledger.get()
+    if ledger is not None:
+        ledger.offer(iteration, answer, score)
+
+async def arun_iteration(user_prompt, temperature, max_tokens, final_tokens, timings, backend=None, stream=None,
+                         iteration=0, memory=None, schedule=iteration_schedule, preset=None):
+    # Every layer is a task that starts as soon as the layers in its prompt have finished.
+    # Returns the outputs and fills `timings` in layer order. Layers named in `preset` take its output
+    # instead of calling the model.
+    tasks = {}
+    preset = preset or {}
+    offset = len(timings)
+    timings.extend([None] * len(pipeline.layers))
+
+    async def layer_task(number, layer):
+        params = None
+        if layer.name in preset:
+            start = time.perf_counter()
+            result = preset[layer.name]
+            if stream and layer is pipeline.answer:
+                stream.finished(iteration, result)
+        else:
+            inputs = [await tasks[name] for name in layer.inputs]
+            # Timed from here, so the duration is the layer's own call and not the wait for its inputs
+            start = time.perf_counter()
+            layer_temperature, layer_tokens = shared_params(
+                layer, schedule, *pipeline.layer_params(layer, temperature, max_tokens, final_tokens))
+            with tracer.span("layer", layer=number, iteration=iteration, temperature=layer_temperature):
+                result = await arun_layer(layer, user_prompt, inputs, layer_temperature, layer_tokens, backend,
+                                          stream if layer is pipeline.answer else None, iteration)
+            params = {"name": layer.name, "model": layer.model, "temperature": layer_temperature,
+                      "max_tokens": layer_tokens}
+        duration = time.perf_counter() - start
+        timings[offset + number - 1] = round(duration, 3)
+        if memory is not None:
+            memory.store(number, result, iteration=iteration, duration=duration, params=params)
+        return result
+
+    for number, layer in enumerate(pipeline.layers, 1):
+        tasks[layer.name] = asyncio.ensure_future(layer_task(number, layer))
+    return list(await gather_or_cancel(tasks.values()))
+
+def warm_presets(layers):
+    # The outputs of every layer but the answer's in each iteration of a similar past job, as
+    # {iteration: {layer name: output}} for arun_iteration
+    return {i: {layer.name: output for layer, output in zip(pipeline.layers, outputs) if layer is not pipeline.answer}
+            for i, outputs in enumerate(layers) if len(outputs) == len(pipeline.layers)}
+
+def restore_checkpoint(checkpoint, memory):
+    # Puts the checkpointed layer outputs of a job back in its memory and returns them as presets
+    presets = {}
+    for (iteration, number), record in sorted(checkpoint.layers.items()):
+        memory.store(number, record["text"], iteration=iteration, duration=record["duration"])
+        presets.setdefault(iteration, {})[record["name"]] = record["text"]
+    return presets
+
+async def arun_pipeline(user_prompt, iterations=3, backend=None, schedule=iteration_schedule, stream=None,
+                        score_early=False, memory=None, presets=None):
+    # Same graph as build_pipeline, but every iteration is a coroutine on the running loop,
+    # so many jobs can share one event loop and the MAX_IN_FLIGHT request limit.
+    layer_timings = [[] for _ in range(iterations)]
+    score_timings = []
+
+    async def run(i):
+        temperature, max_tokens, final_tokens = schedule(i)
+        outputs = await arun_iteration(user_prompt, temperature, max_tokens, final_tokens, layer_timings[i], backend,
+                                       stream, i, memory, schedule, (presets or {}).get(i))
+        if not score_early:
+            offer_candidate(i, outputs[-1])
+            return outputs, None
+        scored = await _timed(agpt4o_score(user_prompt, [outputs[-1]], backend), score_timings, layer="score",
+                              iteration=i)
+        offer_candidate(i, *scored)
+        return outputs, scored
+
+    results = await gather_or_cancel(run(i) for i in range(iterations))
+    layers = [outputs for outputs, _ in results]
+    if score_early:
+        best_answer, best_score = best_scored([scored for _, scored in results])
+    else:
+        best_answer, best_score = await _timed(agpt4o_score(user_prompt, [outputs[-1] for outputs in layers], backend),
+                                               score_timings, layer="score")
+    return {
+        "best_answer": best_answer,
+        "best_score": best_score,
+        "layers": layers,
+        "layer_timings": layer_timings,
+        "score_time": max(score_timings),
+    }
+
+async def arun_adaptive(user_prompt, controller, backend=None, schedule=iteration_schedule, stream=None, memory=None,
+                        presets=None):
+    # Runs iterations in waves chosen by an IterationController. Every candidate is scored on its own as
+    # soon as it is finished, so the controller can stop early on easy prompts or keep going on hard ones.
+    meter = UsageMeter(backend or default_backend)
+    start = time.perf_counter()
+    layers, layer_timings, scored, score_timings, waves = [], [], [], [], []
+
+    async def run(i):
+        layer_timings.append([])
+        temperature, max_tokens, final_tokens = schedule(i)
+        outputs = await arun_iteration(user_prompt, temperature, max_tokens, final_tokens, layer_timings[-1], meter,
+                                       stream, i, memory, schedule, (presets or {}).get(i))
+        scored = await _timed(agpt4o_score(user_prompt, [outputs[-1]], meter), score_timings, layer="score",
+                              iteration=i)
+        offer_candidate(i, *scored)
+        return outputs, scored
+
+    while True:
+        wave, reason = controller.next_wave([score for _, score in scored], waves, meter.total_tokens,
+                                            time.perf_counter() - start)
+        if not wave:
+            break
+        results = await gather_or_cancel(run(len(layers) + k) for k in range(wave))
+        layers.extend(outputs for outputs, _ in results)
+        scored.extend(candidate for _, candidate in results)
+        waves.append(wave)
+        logging.info("Wave %s: scores %s, %s tokens", len(waves), [score for _, score in scored], meter.total_tokens)
+
+    logging.info("Stopped after %s iterations: %s", len(layers), reason)
+    best_answer, best_score = best_scored(scored)
+    return {
+        "best_answer": best_answer,
+        "best_score": best_score,
+        "layers": layers,
+        "layer_timings": layer_timings,
+        "score_time": max(score_timings),
+        "scores": [score for _, score in scored],
+        "stop_reason": reason,
+        "tokens": meter.total_tokens,
+    }
+
+def prompt_hash(user_prompt):
+    return hashlib.sha256(user_prompt.encode()).hexdigest()
+
+# Fields checked, in order, for the prompt text of a JSONL record
+PROMPT_FIELDS = ("prompt", "body", "text")
+
+def read_prompts(path):
+    # Yields (job_id, prompt) one line at a time so large files are never loaded whole
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                yield None, record
+                continue
+            user_prompt = next((record[field] for field in PROMPT_FIELDS if field in record), None)
+            if user_prompt is None:
+                logging.warning("Skipping record without a prompt field: %s", line[:80])
+                continue
+            yield record.get("request_id", record.get("id")), user_prompt
+
+def completed_hashes(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Truncated last line of an interrupted run
+            if "error" not in record:
+                done.add(record["prompt_hash"])
+    return done
+
+async def arun_budgeted(work, ledger):
+    # Runs a pipeline coroutine until it finishes or reaches a limit of the ledger's budget. At a limit its
+    # calls in flight are cancelled and the best candidate finished so far is returned with the limit as
+    # "stop_reason".
+    loop = asyncio.get_running_loop()
+    exceeded = asyncio.Event()
+    ledger.on_exceeded = lambda: loop.call_soon_threadsafe(exceeded.set)
+    token = current_ledger.set(ledger)
+    try:
+        task = asyncio.ensure_future(work)
+        watcher = asyncio.ensure_future(exceeded.wait())
+        try:
+            await asyncio.wait([task, watcher], timeout=ledger.remaining_seconds(), return_when=FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+    finally:
+        current_ledger.reset(token)
+
+    if not task.cancelled() and not isinstance(task.exception(), BudgetExceeded):
+        return task.result()
+    reason = ledger.exceeded or "time_budget"
+    best_answer, best_score = ledger.best()
+    if best_answer is None:
+        raise BudgetExceeded(f"{reason} reached before any candidate was finished")
+    logging.info("Stopped at the %s with %s candidates", reason, len(ledger.candidates))
+    return {"best_answer": best_answer, "best_score": best_score, "stop_reason": reason,
+            "candidates": len(ledger.candidates)}
+
+async def arun_within_budget(user_prompt, iterations=3, backend=None, score_early=False, controller=None, stream=None,
+                             memory=None, ledger=None):
+    # Runs one job within the budget (see arun_budgeted) and records its calls in a Ledger, added to the
+    # result as "usage". A similar past job from the semantic cache either answers the job right away or
+    # lets it start from that job's layer outputs; either way the result names it as "semantic_hit". With
+    # --checkpoint-dir, a job that was interrupted or failed before resumes from the layer outputs in its
+    # checkpoint and only calls the missing layers ("resumed_layers" in the result). The checkpoint is named
+    # after the job's id, or the prompt hash outside of a job context, and deleted once the job finished.
+    ledger = ledger or Ledger(budget)
+    hit = semantic_cache.lookup(user_prompt, pipeline.fingerprint) if semantic_cache is not None else None
+    if hit is not None and not hit["warm"]:
+        stored = hit.pop("result")
+        return {"best_answer": stored["best_answer"], "best_score": stored["best_score"], "semantic_hit": hit,
+                "usage": ledger.summary()}
+    presets = warm_presets(hit.pop("result")["layers"]) if hit is not None else {}
+
+    saved = None
+    if checkpoints is not None:
+        if memory is None:
+            memory = Memory(job_id=current_job.get() or prompt_hash(user_prompt), checkpoint=checkpoints)
+        saved = checkpoints.load(memory.job_id)
+        if saved is not None and saved.fingerprint == pipeline.fingerprint:
+            for i, outputs in restore_checkpoint(saved, memory).items():
+                presets[i] = dict(presets.get(i, {}), **outputs)
+            logging.info("Resuming job %s from %s checkpointed layer outputs", memory.job_id, len(saved.layers))
+        checkpoints.start(memory.job_id, user_prompt, pipeline.fingerprint, saved)
+
+    if controller:
+        work = arun_adaptive(user_prompt, controller, backend, stream=stream, memory=memory, presets=presets)
+    else:
+        work = arun_pipeline(user_prompt, iterations, backend, stream=stream, score_early=score_early, memory=memory,
+                             presets=presets)
+    try:
+        result = await arun_budgeted(work, ledger)
+    finally:
+        if checkpoints is not None:
+            checkpoints.release(memory.job_id)
+    if checkpoints is not None:
+        # A result cut short by this run's budget is not final: a later run may have the budget to finish
+        # the job, so only complete results end the checkpoint
+        if "layers" in result:
+            checkpoints.finish(memory.job_id)
+        if saved is not None and saved.fingerprint == pipeline.fingerprint:
+            result["resumed_layers"] = len(saved.layers)
+    if hit is not None:
+        result["semantic_hit"] = hit
+    elif semantic_cache is not None and "layers" in result:
+        semantic_cache.store(user_prompt, pipeline.fingerprint, result)
+    result["usage"] = ledger.summary()
+    logging.info("Job usage: %s", result["usage"])
+    return result
+
+async def arun_job(user_prompt, job_id, iterations=3, backend=None, score_early=False, controller=None, stream=None):
+    # Runs one job in its own log context and span. A failure is logged and returned as the record's "error".
+    record = {}
+    start = time.perf_counter()
+    ledger = Ledger(budget)
+    with job_context(job_id), tracer.span("job", job=job_id) as span:
+        try:
+            record.update(await arun_within_budget(user_prompt, iterations, backend, score_early, controller, stream,
+                                                   ledger=ledger))
+        except Exception as e:
+            logging.exception("Job %s failed", job_id)
+            record["error"] = repr(e)
+            record["usage"] = ledger.summary()
+            span.status = type(e).__name__
+    record["elapsed"] = round(time.perf_counter() - start, 3)
+    return record
+
+async def arun_batch(input_path, output_path, workers=4, iterations=3, backend=None, score_early=False,
+                     controller=None, metrics_file=None):
+    # Streams prompts from input_path through a fixed pool of worker coroutines and appends one
+    # JSONL result per job as soon as it finishes. Prompts already answered in output_path are skipped.
+    done = completed_hashes(output_path)
+    queue = asyncio.Queue(maxsize=workers * 2)
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+
+    with open(output_path, "a+", encoding="utf-8") as out:
+        out.seek(0, os.SEEK_END)
+        if out.tell():
+            out.seek(out.tell() - 1)
+            if out.read(1) != "\n":
+                out.write("\n")
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                job_id, user_prompt, digest = item
+                record = {"id": job_id, "prompt_hash": digest, "prompt": user_prompt}
+                record.update(await arun_job(user_prompt, digest, iterations, backend, score_early, controller))
+                counts["failed" if "error" in record else "done"] += 1
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                if metrics_file:
+                    # Keep a textfile scraper current during long batches
+                    metrics.write(metrics_file)
+
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        for job_id, user_prompt in read_prompts(input_path):
+            digest = prompt_hash(user_prompt)
+            if digest in done:
+                counts["skipped"] += 1
+                continue
+            done.add(digest)
+            await queue.put((job_id, user_prompt, digest))
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+
+    logging.info("Batch finished: %s", counts)
+    return counts
+
+class _NoProgress:
+    # Stand-in for tqdm when it is not installed or there is nothing to show
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def update(self, n=1):
+        pass
+
+def progress_bar(total, desc):
+    # tqdm is only imported for interactive runs with DEBUG on, so importing mmps stays cheap
+    if not DEBUG:
+        return _NoProgress()
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        return _NoProgress()
+    return tqdm(total=total, desc=desc)
+
+def _run_interactive_job(user_prompt, iterations, backend, sink, score_early, controller, memory):
+    if controller or budget or semantic_cache is not None or checkpoints is not None:
+        # The number of iterations is only known while running, calls in flight can only be cancelled at a
+        # budget's limit, and warm starts and resumed jobs skip layers only on the async engine, so these
+        # runs use it
+        result = asyncio.run(arun_within_budget(user_prompt, iterations, backend, score_early, controller, sink,
+                                                memory))
+        return result["best_answer"], result["best_score"]
+    ledger = Ledger()
+    current_ledger.set(ledger)
+    graph = TaskGraph()
+    build_pipeline(graph, user_prompt, iterations, backend, stream=sink, score_early=score_early)
+
+    def on_done(name, result):
+        progress.update()
+        if isinstance(name, tuple) and isinstance(name[1], int):
+            memory.store(name[1], result, iteration=name[0], duration=graph.duration(name))
+
+    with ThreadPoolExecutor() as executor, progress_bar(len(graph.nodes), "Processing") as progress:
+        results = graph.run(executor, on_done=on_done)
+    for name, duration in graph.critical_path():
+        logging.info("Critical path: %s took %.2fs", name, duration)
+    logging.info("Job usage: %s", ledger.summary())
+    return results["score"]
+
+def run_interactive(iterations=3, backend=None, stream=False, score_early=False, controller=None, resume=None):
+    if resume:
+        # The checkpoint's first line holds the prompt, so the job can be resumed by its hash alone
+        user_prompt = checkpoints.load(checkpoints.find(resume)).prompt
+        print(f"Resuming job with prompt: {user_prompt}")
+    else:
+        user_prompt = input("Enter your main prompt: ")
+    # With checkpoints the job is named by its prompt hash, so the id in the logs is the one --resume takes
+    setup_logging(user_prompt, prompt_hash(user_prompt) if checkpoints is not None else None)
+    logging.debug("Received user prompt: %s", user_prompt)
+    memory = Memory(job_id=prompt_hash(user_prompt), checkpoint=checkpoints)
+    if checkpoints is not None:
+        logging.info("Checkpointing to %s, resume with --resume %s", checkpoints.path(memory.job_id), memory.job_id)
+
+    sink = StdoutSink() if stream else None
+    try:
+        with tracer.span("job", job=current_job.get()):
+            best_answer, best_score = _run_interactive_job(user_prompt, iterations, backend, sink, score_early,
+                                                           controller, memory)
+    except BudgetExceeded as e:
+        # Batch runs record this as the job's error; here it ends the run with a message instead of a traceback
+        logging.error("Job stopped: %s", e)
+        sys.exit(f"Job stopped: {e}")
     # Print the best score before the best answer
     print(f'Best Score: {best_score}\n')
     # Print the best scored answer
     print(f'Do not simplify anything it is waste of time.\nCompare with original functionality.\nDo not explain, just generate full code in one shot. \nUse exactly how and what is in that instructions and requirements to implement it in best way, fully working solution.\n"""{best_answer}"""')
-    logging.debug(f"Final best answer: {best_answer} with score: {best_score}")
+    logging.debug("Final best answer: %s with score: %s", best_answer, best_score)
+
+def add_pipeline_arguments(parser):
+    # Flags shared by every way of running jobs: interactive, --batch and the job server (mmps_server.py)
+    parser.add_argument("--pipeline", metavar="SPEC", help="pipeline spec (.toml, .yaml or .json) with layers, models and schedule")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="maximum concurrent model requests")
+    parser.add_argument("--iterations", type=int, help="iterations per job (default: from the pipeline spec)")
+    parser.add_argument("--score-early", action="store_true", help="score every answer as soon as it is finished")
+    parser.add_argument("--backend", choices=("openai", "fake"), default="openai", help="model backend (fake runs offline)")
+    parser.add_argument("--base-url", help="OpenAI-compatible endpoint, e.g. the fake server from mmps_backends.py")
+    parser.add_argument("--merge-siblings", action="store_true",
+                        help="send identical calls of sibling iterations as one request with n choices")
+    parser.add_argument("--merge-window", type=float, default=0.01, help="seconds a call waits for siblings to merge with")
+    add_fake_arguments(parser)
+    add_governor_arguments(parser)
+    add_controller_arguments(parser)
+    add_logging_arguments(parser)
+    add_telemetry_arguments(parser)
+    add_compaction_arguments(parser)
+    add_scoring_arguments(parser)
+    add_cost_arguments(parser)
+    add_semantic_arguments(parser)
+    add_checkpoint_arguments(parser)
+    parser.add_argument("--cache", metavar="PATH", help="SQLite file used to cache model responses")
+    parser.add_argument("--cache-ttl", type=float, default=7 * 24 * 3600, help="seconds a cached response stays valid")
+    parser.add_argument("--cache-max-mb", type=float, default=256, help="size above which least recently used responses are evicted")
+    parser.add_argument("--cache-sampled", action="store_true", help="also cache calls with temperature > 0 (deterministic replays)")
+
+def parse_args(parser, argv=None):
+    # The spec's iteration count and scoring settings become defaults that flags can still override
+    spec_args, _ = parser.parse_known_args(argv)
+    spec = load_pipeline(spec_args.pipeline) if spec_args.pipeline else pipeline
+    parser.set_defaults(iterations=spec.iterations, **{SCORING_DEFAULTS[key]: value for key, value in spec.scoring.items()})
+    return parser.parse_args(argv)
+
+def configure(args):
+    # Applies the parsed flags to the module-wide settings and returns (backend, governor, controller).
+    # Worker processes of the job server start from a fresh interpreter and call this with the server's flags.
+    global MAX_IN_FLIGHT, SHARED_KEYWORDS, response_cache, semantic_cache, checkpoints, compactor, scorer, pipeline
+    global prices, budget
+    if args.pipeline:
+        pipeline = load_pipeline(args.pipeline)
+    configure_logging(args.log_dir, max_chars=args.log_max_chars, debug_sample=args.log_debug_sample)
+    configure_telemetry(args)
+    compactor = compactor_from_args(args)
+    scorer = scorer_from_args(args)
+    prices = prices_from_args(args)
+    budget = budget_from_args(args)
+    MAX_IN_FLIGHT = args.max_in_flight
+    controller = controller_from_args(args)
+    if args.backend == "fake":
+        governor = governor_from_args(args)
+        backend = GovernedBackend(fake_backend_from_args(args), governor)
+    else:
+        # The governor retries instead of the SDK so that all jobs share one backoff schedule
+        governor = governor_from_args(args, DEFAULT_LIMITS)
+        backend = GovernedBackend(OpenAIBackend(API_KEY, base_url=args.base_url, max_retries=0), governor)
+    if args.merge_siblings:
+        # Outside the governor, so that a merged request is throttled and retried as one
+        SHARED_KEYWORDS = True
+        backend = MergingBackend(backend, window=args.merge_window)
+    if args.cache:
+        response_cache = ResponseCache(args.cache, ttl=args.cache_ttl, max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                                       cache_sampled=args.cache_sampled)
+    semantic_cache = semantic_cache_from_args(args)
+    checkpoints = checkpoints_from_args(args)
+    return backend, governor, controller
+
+def report(args, backend, governor):
+    # Logs the stats of the shared components, closes the cache and writes out the telemetry
+    global response_cache, semantic_cache, checkpoints
+    logging.info("Rate governor stats: %s", governor.stats)
+    if args.merge_siblings:
+        logging.info("Sibling merging stats: %s", backend.stats())
+    if response_cache is not None:
+        logging.info("Response cache stats: %s", response_cache.stats())
+        response_cache.close()
+        response_cache = None
+    if semantic_cache is not None:
+        logging.info("Semantic cache stats: %s", semantic_cache.stats())
+        semantic_cache.close()
+        semantic_cache = None
+    if checkpoints is not None:
+        checkpoints.close()
+        checkpoints = None
+    if compactor is not None:
+        logging.info("Prompt compaction stats: %s", compactor.stats())
+    tracer.close()
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-Model Prompt Synthesis")
+    add_pipeline_arguments(parser)
+    parser.add_argument("--batch", metavar="PROMPTS_JSONL", help="run every prompt of a JSONL file instead of asking for one")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file the batch results are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="number of jobs processed at once in batch mode")
+    parser.add_argument("--stream", action="store_true", help="print the final answers while they are generated")
+    parser.add_argument("--resume", metavar="JOB",
+                        help="resume an interrupted or failed job from its checkpoint (prompt hash or a prefix of it)")
+    args = parse_args(parser)
+    if args.resume and not args.checkpoint_dir:
+        parser.error("--resume needs --checkpoint-dir")
+
+    backend, governor, controller = configure(args)
+    try:
+        if not args.batch:
+            run_interactive(args.iterations, backend, stream=args.stream, score_early=args.score_early,
+                            controller=controller, resume=args.resume)
+        else:
+            counts = asyncio.run(arun_batch(args.batch, args.output, workers=args.workers, iterations=args.iterations,
+                                            backend=backend, score_early=args.score_early, controller=controller,
+                                            metrics_file=args.metrics_file))
+            print(f"Processed {counts['done']} prompts ({counts['failed']} failed, {counts['skipped']} already done) -> {args.output}")
+    finally:
+        report(args, backend, governor)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,689 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+
+
+def request_key(messages, model, max_tokens, temperature, options=None):
+    # Extra request options only enter the key when there are any, so older recordings stay valid
+    request = [model, messages, max_tokens, temperature] + ([options] if options else [])
+    payload = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Set around calls that sibling iterations make with the same request (see MergingBackend), so that only
+# those wait for siblings to merge with
+expect_siblings = contextvars.ContextVar("mmps_expect_siblings", default=False)
+
+
+def estimate_tokens(text):
+    # Rough local token count (about four characters per token) for when the API reports no usage
+    return len(text) // 4 + 1
+
+
+class ModelResponse:
+    # `logprobs` maps the most likely first completion tokens to their log probability, when requested
+    __slots__ = ("text", "model", "prompt_tokens", "completion_tokens", "headers", "logprobs")
+
+    def __init__(self, text, model, prompt_tokens=0, completion_tokens=0, headers=None, logprobs=None):
+        self.text = text
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.headers = headers
+        self.logprobs = logprobs
+
+
+def choice_responses(texts, model, prompt_tokens, completion_tokens, headers=None):
+    # Usage is reported for a whole n-choice request: the prompt is charged to the first choice and the
+    # completion tokens are shared out by the length of each choice
+    total = sum(len(text) for text in texts) or 1
+    return [ModelResponse(text, model, prompt_tokens if i == 0 else 0, round(completion_tokens * len(text) / total), headers)
+            for i, text in enumerate(texts)]
+
+
+def complete_choices(backend, messages, model, max_tokens, temperature, n):
+    # n completions of one request, as a single API call when the backend supports it
+    if hasattr(backend, "complete_choices"):
+        return backend.complete_choices(messages, model, max_tokens, temperature, n)
+    return [backend.complete(messages, model, max_tokens, temperature) for _ in range(n)]
+
+
+async def acomplete_choices(backend, messages, model, max_tokens, temperature, n):
+    if hasattr(backend, "acomplete_choices"):
+        return await backend.acomplete_choices(messages, model, max_tokens, temperature, n)
+    return list(await asyncio.gather(*(backend.acomplete(messages, model, max_tokens, temperature) for _ in range(n))))
+
+
+class BackendError(Exception):
+    # Raised by backends for failed calls; status follows the HTTP code the API would have returned
+    def __init__(self, message, status=500, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+
+
+class OpenAIBackend:
+    # Chat completions through the OpenAI SDK. Clients are created on first use, so building a
+    # backend never touches the network; base_url points it at any compatible server. SDK errors are
+    # raised as BackendError, and max_retries=0 leaves retrying to a GovernedBackend.
+    def __init__(self, api_key, base_url=None, max_retries=2):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=self.max_retries)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=self.max_retries)
+        return self._async_client
+
+    @staticmethod
+    def _response(raw, model):
+        completion = raw.parse()
+        usage = completion.usage
+        choice = completion.choices[0]
+        logprobs = None
+        if getattr(choice, "logprobs", None) and choice.logprobs.content:
+            logprobs = {alternative.token: alternative.logprob for alternative in choice.logprobs.content[0].top_logprobs}
+        return ModelResponse((choice.message.content or "").strip(), model,
+                             usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0,
+                             dict(raw.headers), logprobs)
+
+    @staticmethod
+    def _choices(raw, model):
+        completion = raw.parse()
+        usage = completion.usage
+        texts = [choice.message.content.strip() for choice in sorted(completion.choices, key=lambda c: c.index)]
+        return choice_responses(texts, model, usage.prompt_tokens if usage else 0,
+                                usage.completion_tokens if usage else 0, dict(raw.headers))
+
+    @staticmethod
+    def _error(e):
+        import openai
+        if isinstance(e, openai.APIStatusError):
+            return BackendError(str(e), status=e.status_code, headers=dict(e.response.headers))
+        if isinstance(e, openai.APITimeoutError):
+            return BackendError(str(e), status=408)
+        return BackendError(str(e), status=503)
+
+    def complete(self, messages, model, max_tokens, temperature, **options):
+        # `options` are further chat completion parameters, such as response_format or logprobs
+        import openai
+        try:
+            raw = self.client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **options
+            )
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            raise self._error(e) from e
+        return self._response(raw, model)
+
+    async def acomplete(self, messages, model, max_tokens, temperature, **options):
+        import openai
+        try:
+            raw = await self.async_client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **options
+            )
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            raise self._error(e) from e
+        return self._response(raw, model)
+
+    def complete_choices(self, messages, model, max_tokens, temperature, n):
+        # One request sampled n times with the API's `n` parameter; the prompt is only processed once
+        import openai
+        try:
+            raw = self.client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                n=n
+            )
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            raise self._error(e) from e
+        return self._choices(raw, model)
+
+    async def acomplete_choices(self, messages, model, max_tokens, temperature, n):
+        import openai
+        try:
+            raw = await self.async_client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                n=n
+            )
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            raise self._error(e) from e
+        return self._choices(raw, model)
+
+    def stream(self, messages, model, max_tokens, temperature):
+        # Yields the completion text as it is generated
+        import openai
+        try:
+            chunks = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True
+            )
+            for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            raise self._error(e) from e
+
+    async def astream(self, messages, model, max_tokens, temperature):
+        import openai
+        try:
+            chunks = await self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True
+            )
+            async for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except (openai.APIStatusError, openai.APIConnectionError) as e:
+            raise self._error(e) from e
+
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+WORDS = ("signal", "buffer", "delay", "feedback", "sample", "channel", "filter", "decay", "mix", "input",
+         "output", "frame", "rate", "stereo", "function", "parameter", "loop", "array", "stream", "value")
+
+
+class FakeBackend:
+    # Local stand-in for the model API. The text of a response depends only on the request, so runs
+    # are reproducible; latency is time-to-first-token drawn from `distribution` (mean `latency`,
+    # spread `spread`) plus completion tokens at `tokens_per_second`. A `failure_rate` share of
+    # calls raises BackendError(503) after the first-token delay.
+    def __init__(self, latency=0.5, distribution="lognormal", spread=0.5, tokens_per_second=80.0,
+                 failure_rate=0.0, seed=0):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{distribution}', expected one of {LATENCY_DISTRIBUTIONS}")
+        self.latency = latency
+        self.distribution = distribution
+        self.spread = spread
+        self.tokens_per_second = tokens_per_second
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def _sample_latency(self):
+        if self.latency <= 0 or self.distribution == "fixed":
+            return max(self.latency, 0.0)
+        with self.lock:
+            if self.distribution == "uniform":
+                return self.rng.uniform(self.latency * (1 - self.spread), self.latency * (1 + self.spread))
+            if self.distribution == "exponential":
+                return self.rng.expovariate(1 / self.latency)
+            # Shift mu so that the mean of the lognormal equals `latency`
+            return self.rng.lognormvariate(math.log(self.latency) - self.spread ** 2 / 2, self.spread)
+
+    def _fails(self):
+        with self.lock:
+            self.calls += 1
+            failed = self.rng.random() < self.failure_rate
+            self.failures += failed
+            return failed
+
+    def _respond(self, messages, model, max_tokens, temperature, choice=0, options=None):
+        prompt = " ".join(message["content"] for message in messages)
+        request = [model, messages, max_tokens, temperature] + ([choice] if choice else [])
+        seed = hashlib.sha256(json.dumps(request).encode()).digest()
+        rng = random.Random(seed)
+        prompt_tokens = estimate_tokens(prompt)
+        responses = len(re.findall(r"^Response \d+:", prompt, re.MULTILINE))
+        if responses and "scoring technique" in prompt:
+            scores = [rng.randint(1, 10) for _ in range(responses)]
+            options = options or {}
+            if options.get("response_format", {}).get("type") == "json_schema":
+                text = json.dumps({"scores": [{"response": i + 1, "score": score} for i, score in enumerate(scores)]})
+            else:
+                text = ",".join(str(score) for score in scores)
+            logprobs = None
+            if options.get("logprobs"):
+                # Probability mass falls off around the chosen score
+                weights = {str(d): math.exp(-abs(d - scores[0])) for d in range(1, 11)}
+                total = sum(weights.values())
+                top = sorted(weights, key=weights.get, reverse=True)[:options.get("top_logprobs", 5)]
+                logprobs = {token: math.log(weights[token] / total) for token in top}
+            return ModelResponse(text, model, prompt_tokens, estimate_tokens(text), logprobs=logprobs)
+        completion_tokens = rng.randint(max(1, max_tokens // 2), max(1, max_tokens))
+        words = [rng.choice(WORDS) for _ in range(max(1, completion_tokens * 3 // 4))]
+        return ModelResponse(f"[{model} t={temperature}] " + " ".join(words), model, prompt_tokens, completion_tokens)
+
+    def _delays(self, response):
+        return self._sample_latency(), response.completion_tokens / self.tokens_per_second
+
+    def complete(self, messages, model, max_tokens, temperature, **options):
+        response = self._respond(messages, model, max_tokens, temperature, options=options)
+        first_token, generation = self._delays(response)
+        time.sleep(first_token)
+        if self._fails():
+            raise BackendError("Simulated backend failure", status=503)
+        time.sleep(generation)
+        return response
+
+    async def acomplete(self, messages, model, max_tokens, temperature, **options):
+        response = self._respond(messages, model, max_tokens, temperature, options=options)
+        first_token, generation = self._delays(response)
+        await asyncio.sleep(first_token)
+        if self._fails():
+            raise BackendError("Simulated backend failure", status=503)
+        await asyncio.sleep(generation)
+        return response
+
+    def _respond_choices(self, messages, model, max_tokens, temperature, n):
+        # The choices are generated in parallel, so the request takes as long as its longest choice
+        responses = [self._respond(messages, model, max_tokens, temperature, choice) for choice in range(n)]
+        merged = choice_responses([response.text for response in responses], model, responses[0].prompt_tokens,
+                                  sum(response.completion_tokens for response in responses))
+        return merged, self._sample_latency(), max(r.completion_tokens for r in responses) / self.tokens_per_second
+
+    def complete_choices(self, messages, model, max_tokens, temperature, n):
+        responses, first_token, generation = self._respond_choices(messages, model, max_tokens, temperature, n)
+        time.sleep(first_token)
+        if self._fails():
+            raise BackendError("Simulated backend failure", status=503)
+        time.sleep(generation)
+        return responses
+
+    async def acomplete_choices(self, messages, model, max_tokens, temperature, n):
+        responses, first_token, generation = self._respond_choices(messages, model, max_tokens, temperature, n)
+        await asyncio.sleep(first_token)
+        if self._fails():
+            raise BackendError("Simulated backend failure", status=503)
+        await asyncio.sleep(generation)
+        return responses
+
+    @staticmethod
+    def _chunks(text, words_per_chunk=4):
+        words = text.split(" ")
+        for start in range(0, len(words), words_per_chunk):
+            chunk = " ".join(words[start:start + words_per_chunk])
+            yield chunk if start + words_per_chunk >= len(words) else chunk + " "
+
+    def stream(self, messages, model, max_tokens, temperature):
+        response = self._respond(messages, model, max_tokens, temperature)
+        first_token, generation = self._delays(response)
+        chunks = list(self._chunks(response.text))
+        time.sleep(first_token)
+        if self._fails():
+            raise BackendError("Simulated backend failure", status=503)
+        for chunk in chunks:
+            yield chunk
+            time.sleep(generation / len(chunks))
+
+    async def astream(self, messages, model, max_tokens, temperature):
+        response = self._respond(messages, model, max_tokens, temperature)
+        first_token, generation = self._delays(response)
+        chunks = list(self._chunks(response.text))
+        await asyncio.sleep(first_token)
+        if self._fails():
+            raise BackendError("Simulated backend failure", status=503)
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(generation / len(chunks))
+
+
+class UsageMeter:
+    # Backend wrapper that adds up the token usage of every call made through it. Streams report no
+    # usage, so their tokens are estimated from the text.
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def _add(self, response):
+        self.calls += 1
+        self.prompt_tokens += response.prompt_tokens
+        self.completion_tokens += response.completion_tokens
+        return response
+
+    def _add_stream(self, messages, model, chunks):
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        self._add(ModelResponse("", model, prompt_tokens, estimate_tokens("".join(chunks))))
+
+    def complete(self, messages, model, max_tokens, temperature, **options):
+        return self._add(self.backend.complete(messages, model, max_tokens, temperature, **options))
+
+    async def acomplete(self, messages, model, max_tokens, temperature, **options):
+        return self._add(await self.backend.acomplete(messages, model, max_tokens, temperature, **options))
+
+    def complete_choices(self, messages, model, max_tokens, temperature, n):
+        return [self._add(r) for r in complete_choices(self.backend, messages, model, max_tokens, temperature, n)]
+
+    async def acomplete_choices(self, messages, model, max_tokens, temperature, n):
+        return [self._add(r) for r in await acomplete_choices(self.backend, messages, model, max_tokens, temperature, n)]
+
+    def stream(self, messages, model, max_tokens, temperature):
+        chunks = []
+        for delta in self.backend.stream(messages, model, max_tokens, temperature):
+            chunks.append(delta)
+            yield delta
+        self._add_stream(messages, model, chunks)
+
+    async def astream(self, messages, model, max_tokens, temperature):
+        chunks = []
+        async for delta in self.backend.astream(messages, model, max_tokens, temperature):
+            chunks.append(delta)
+            yield delta
+        self._add_stream(messages, model, chunks)
+
+
+class MergingBackend:
+    # Merges concurrent identical requests (same model, messages, max_tokens and temperature) into one
+    # request with n choices and hands one choice to each caller. A call made while `expect_siblings` is set
+    # opens a group and waits `window` seconds for siblings to join; other calls join an open group but are
+    # otherwise sent on their own right away, so calls that cannot have siblings never wait. At most
+    # `max_choices` calls share one request. Callers of a group may belong to different jobs, so a merged
+    # request is only cancelled once every caller waiting for it was cancelled. Streams are passed through
+    # unmerged.
+    def __init__(self, backend, window=0.01, max_choices=8):
+        self.backend = backend
+        self.window = window
+        self.max_choices = max_choices
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.requests = 0
+        self.merged = 0
+
+    def _join(self, key, new_group):
+        # Returns (group, index of this caller's choice, whether this caller opened it), or (None, 0, False)
+        # when the call should be sent on its own
+        with self.lock:
+            group = self.pending.get(key)
+            if group is not None and group["size"] < self.max_choices:
+                group["size"] += 1
+                group["waiters"] += 1
+                return group, group["size"] - 1, False
+            if not expect_siblings.get():
+                self.requests += 1
+                return None, 0, False
+            group = self.pending[key] = dict(new_group(), size=1, waiters=1)
+            return group, 0, True
+
+    def _close(self, key, group):
+        # No more callers join the group; returns how many choices it asks for
+        with self.lock:
+            if self.pending.get(key) is group:
+                del self.pending[key]
+            self.requests += 1
+            self.merged += group["size"] - 1
+            return group["size"]
+
+    def complete(self, messages, model, max_tokens, temperature, **options):
+        if options:
+            # Calls with extra options (structured output, logprobs) are rare and go through unmerged
+            return self.backend.complete(messages, model, max_tokens, temperature, **options)
+        key = ("sync", request_key(messages, model, max_tokens, temperature))
+        group, index, leader = self._join(key, lambda: {"done": threading.Event()})
+        if group is None:
+            return self.backend.complete(messages, model, max_tokens, temperature)
+        if leader:
+            time.sleep(self.window)
+            n = self._close(key, group)
+            try:
+                group["responses"] = complete_choices(self.backend, messages, model, max_tokens, temperature, n)
+            except Exception as e:
+                group["error"] = e
+            finally:
+                group["done"].set()
+        else:
+            group["done"].wait()
+        if "error" in group:
+            raise group["error"]
+        return group["responses"][index]
+
+    async def acomplete(self, messages, model, max_tokens, temperature, **options):
+        if options:
+            return await self.backend.acomplete(messages, model, max_tokens, temperature, **options)
+        key = ("async", request_key(messages, model, max_tokens, temperature))
+        group, index, leader = self._join(key, dict)
+        if group is None:
+            return await self.backend.acomplete(messages, model, max_tokens, temperature)
+        if leader:
+            group["task"] = asyncio.ensure_future(self._asend(key, group, messages, model, max_tokens, temperature))
+        try:
+            # Shielded so that cancelling one caller does not cancel the request the others wait for
+            return (await asyncio.shield(group["task"]))[index]
+        except asyncio.CancelledError:
+            with self.lock:
+                group["waiters"] -= 1
+                last = not group["waiters"]
+                if last and self.pending.get(key) is group:
+                    del self.pending[key]
+            if last:
+                group["task"].cancel()
+            raise
+
+    async def _asend(self, key, group, messages, model, max_tokens, temperature):
+        await asyncio.sleep(self.window)
+        n = self._close(key, group)
+        return await acomplete_choices(self.backend, messages, model, max_tokens, temperature, n)
+
+    def stream(self, messages, model, max_tokens, temperature):
+        return self.backend.stream(messages, model, max_tokens, temperature)
+
+    def astream(self, messages, model, max_tokens, temperature):
+        return self.backend.astream(messages, model, max_tokens, temperature)
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "merged_calls": self.merged}
+
+
+class RecordingBackend:
+    # Passes calls through to `backend` and appends each request, response, usage and latency to a
+    # JSONL file that ReplayBackend can play back later without network access.
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def _record(self, messages, model, max_tokens, temperature, options, response, latency):
+        line = json.dumps({"key": request_key(messages, model, max_tokens, temperature, options), "model": model,
+                           "text": response.text, "prompt_tokens": response.prompt_tokens,
+                           "completion_tokens": response.completion_tokens, "logprobs": response.logprobs,
+                           "latency": round(latency, 4)})
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def complete(self, messages, model, max_tokens, temperature, **options):
+        start = time.perf_counter()
+        response = self.backend.complete(messages, model, max_tokens, temperature, **options)
+        self._record(messages, model, max_tokens, temperature, options, response, time.perf_counter() - start)
+        return response
+
+    async def acomplete(self, messages, model, max_tokens, temperature, **options):
+        start = time.perf_counter()
+        response = await self.backend.acomplete(messages, model, max_tokens, temperature, **options)
+        self._record(messages, model, max_tokens, temperature, options, response, time.perf_counter() - start)
+        return response
+
+
+class ReplayBackend:
+    # Answers from a RecordingBackend file with the recorded latency scaled by `speed`.
+    # Requests that were never recorded go to `fallback`, or fail with BackendError(404).
+    def __init__(self, path, speed=1.0, fallback=None):
+        self.speed = speed
+        self.fallback = fallback
+        self.recordings = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                self.recordings[record["key"]] = record
+
+    def _lookup(self, messages, model, max_tokens, temperature, options):
+        record = self.recordings.get(request_key(messages, model, max_tokens, temperature, options))
+        if record is None:
+            if self.fallback is None:
+                raise BackendError("Request not found in recording", status=404)
+            return None, 0.0
+        response = ModelResponse(record["text"], record["model"], record["prompt_tokens"], record["completion_tokens"],
+                                 logprobs=record.get("logprobs"))
+        return response, record["latency"] / self.speed
+
+    def complete(self, messages, model, max_tokens, temperature, **options):
+        response, latency = self._lookup(messages, model, max_tokens, temperature, options)
+        if response is None:
+            return self.fallback.complete(messages, model, max_tokens, temperature, **options)
+        time.sleep(latency)
+        return response
+
+    async def acomplete(self, messages, model, max_tokens, temperature, **options):
+        response, latency = self._lookup(messages, model, max_tokens, temperature, options)
+        if response is None:
+            return await self.fallback.acomplete(messages, model, max_tokens, temperature, **options)
+        await asyncio.sleep(latency)
+        return response
+
+
+def serve(backend, host="127.0.0.1", port=8000):
+    # OpenAI-compatible HTTP stand-in: point OpenAIBackend(base_url="http://host:port/v1") at it.
+    # http.server is only imported here so that importing the backends stays cheap.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _ChatCompletionsHandler(BaseHTTPRequestHandler):
+        backend = None
+
+        def do_POST(self):
+            if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+                self._reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            options = {name: request[name] for name in ("response_format", "logprobs", "top_logprobs") if name in request}
+            try:
+                if options:
+                    responses = [self.backend.complete(request["messages"], request["model"], request.get("max_tokens", 100),
+                                                       request.get("temperature", 1.0), **options)]
+                else:
+                    responses = complete_choices(self.backend, request["messages"], request["model"],
+                                                 request.get("max_tokens", 100), request.get("temperature", 1.0),
+                                                 request.get("n", 1))
+            except BackendError as e:
+                self._reply(e.status, {"error": {"message": str(e), "type": "server_error"}})
+                return
+            prompt_tokens = sum(response.prompt_tokens for response in responses)
+            completion_tokens = sum(response.completion_tokens for response in responses)
+            self._reply(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": responses[0].model,
+                "choices": [{"index": i, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": response.text},
+                             "logprobs": self._logprobs(response)}
+                            for i, response in enumerate(responses)],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+        @staticmethod
+        def _logprobs(response):
+            if response.logprobs is None:
+                return None
+            top = [{"token": token, "logprob": logprob, "bytes": list(token.encode())}
+                   for token, logprob in response.logprobs.items()]
+            first = max(top, key=lambda alternative: alternative["logprob"])
+            return {"content": [dict(first, top_logprobs=top)]}
+
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    _ChatCompletionsHandler.backend = backend
+    server = ThreadingHTTPServer((host, port), _ChatCompletionsHandler)
+    server.daemon_threads = True
+    return server
+
+
+def add_fake_arguments(parser):
+    parser.add_argument("--fake-latency", type=float, default=0.5, help="mean time to first token of the fake backend (s)")
+    parser.add_argument("--fake-distribution", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--fake-spread", type=float, default=0.5, help="sigma (lognormal) or relative width (uniform)")
+    parser.add_argument("--fake-tps", type=float, default=80.0, help="completion tokens per second of the fake backend")
+    parser.add_argument("--fake-failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def fake_backend_from_args(args):
+    return FakeBackend(latency=args.fake_latency, distribution=args.fake_distribution, spread=args.fake_spread,
+                       tokens_per_second=args.fake_tps, failure_rate=args.fake_failure_rate, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the fake MMPS model backend over an OpenAI-compatible HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+    server = serve(fake_backend_from_args(args), args.host, args.port)
+    print(f"Fake backend listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,258 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import argparse
+import asyncio
+import datetime
+import functools
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mmps
+from mmps_backends import MergingBackend, ReplayBackend, UsageMeter, add_fake_arguments, fake_backend_from_args
+from mmps_governor import GovernedBackend, add_governor_arguments, governor_from_args
+from mmps_pipeline import load_pipeline
+from mmps_scoring import SCORING_DEFAULTS, add_scoring_arguments, scorer_from_args
+
+
+def percentile(values, q):
+    # Linear interpolation between closest ranks, q in [0, 100]
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS. It is the peak of the whole process, which is
+    # why every configuration runs in a process of its own (see measure_config).
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def parse_schedule(text):
+    start, step, final = (int(value) for value in text.split(":"))
+    return start, step, final
+
+
+async def run_config(prompts, backend, iterations, concurrency, schedule):
+    # Runs every prompt once with at most `concurrency` jobs in flight and collects per-job measurements
+    queue = asyncio.Queue()
+    for user_prompt in prompts:
+        queue.put_nowait(user_prompt)
+    layer_names = tuple(str(number) for number in range(1, len(mmps.pipeline.layers) + 1))
+    layer_times = {name: [] for name in layer_names + ("score", "job")}
+    tokens = {"prompt": [], "completion": [], "calls": []}
+    failed = []
+    pipeline_schedule = functools.partial(mmps.iteration_schedule, max_tokens_start=schedule[0],
+                                          max_tokens_step=schedule[1], final_tokens=schedule[2])
+
+    async def worker():
+        while not queue.empty():
+            user_prompt = queue.get_nowait()
+            meter = UsageMeter(backend)
+            start = time.perf_counter()
+            try:
+                result = await mmps.arun_pipeline(user_prompt, iterations, meter, pipeline_schedule)
+            except Exception as e:
+                failed.append(repr(e))
+                continue
+            layer_times["job"].append(time.perf_counter() - start)
+            for timings in result["layer_timings"]:
+                for name, duration in zip(layer_names, timings):
+                    layer_times[name].append(duration)
+            layer_times["score"].append(result["score_time"])
+            tokens["prompt"].append(meter.prompt_tokens)
+            tokens["completion"].append(meter.completion_tokens)
+            tokens["calls"].append(meter.calls)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall_time = time.perf_counter() - start
+    completed = len(layer_times["job"])
+    return {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "schedule": {"max_tokens_start": schedule[0], "max_tokens_step": schedule[1], "final_tokens": schedule[2]},
+        "jobs": completed,
+        "failed": len(failed),
+        "errors": sorted(set(failed))[:5],
+        "wall_time": round(wall_time, 3),
+        "jobs_per_minute": round(completed / wall_time * 60, 2) if wall_time else None,
+        "latency": {name: summarize(values) for name, values in layer_times.items()},
+        "tokens_per_job": {name: round(sum(values) / len(values), 1) if values else None
+                           for name, values in tokens.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def setup(args):
+    # Pipeline, scorer and backend of a benchmark process, from the command line
+    if args.pipeline:
+        mmps.pipeline = load_pipeline(args.pipeline)
+    mmps.MAX_IN_FLIGHT = args.max_in_flight
+    mmps.scorer = scorer_from_args(args)
+    if args.replay:
+        backend = ReplayBackend(args.replay, speed=args.replay_speed, fallback=fake_backend_from_args(args))
+    else:
+        backend = fake_backend_from_args(args)
+    backend = GovernedBackend(backend, governor_from_args(args))
+    if args.merge_siblings:
+        mmps.SHARED_KEYWORDS = True
+        backend = MergingBackend(backend)
+    return backend
+
+
+def measure_config(args, prompts, iterations, concurrency, schedule):
+    # Runs one configuration in a fresh process, so that its peak RSS, backend state and caches do not
+    # carry over from the configurations before it
+    logging.basicConfig(level=logging.WARNING)
+    return asyncio.run(run_config(prompts, setup(args), iterations, concurrency, schedule))
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def config_key(run):
+    schedule = run["schedule"]
+    return (run["iterations"], run["concurrency"], schedule["max_tokens_start"], schedule["max_tokens_step"],
+            schedule["final_tokens"])
+
+
+def compare(report, baseline, tolerance):
+    # Prints throughput and p95 job latency against a previous report; returns the regressed configs
+    previous = {config_key(run): run for run in baseline["runs"]}
+    regressions = []
+    for run in report["runs"]:
+        old = previous.get(config_key(run))
+        if old is None or not old["jobs_per_minute"] or not run["jobs_per_minute"]:
+            continue
+        throughput = run["jobs_per_minute"] / old["jobs_per_minute"] - 1
+        p95 = run["latency"]["job"].get("p95")
+        old_p95 = old["latency"]["job"].get("p95")
+        latency = p95 / old_p95 - 1 if p95 and old_p95 else 0.0
+        print(f"{config_key(run)}: throughput {throughput:+.1%}, p95 job latency {latency:+.1%}")
+        if throughput < -tolerance or latency > tolerance:
+            regressions.append(config_key(run))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MMPS pipeline against a simulated or recorded backend")
+    parser.add_argument("--jobs", type=int, default=20, help="jobs per configuration")
+    parser.add_argument("--prompts", metavar="PROMPTS_JSONL", help="prompts to cycle through (default: synthetic prompts)")
+    parser.add_argument("--pipeline", metavar="SPEC", help="pipeline spec to benchmark instead of the built-in one")
+    parser.add_argument("--iterations", type=int, nargs="+", help="(default: from the pipeline spec)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8], help="jobs in flight at once")
+    parser.add_argument("--schedule", type=parse_schedule, nargs="+", metavar="START:STEP:FINAL",
+                        help="max_tokens schedule of the iterations and the last layer (default: from the pipeline spec)")
+    parser.add_argument("--max-in-flight", type=int, default=mmps.MAX_IN_FLIGHT)
+    parser.add_argument("--replay", metavar="RECORDING_JSONL", help="replay a RecordingBackend file instead of the fake")
+    parser.add_argument("--replay-speed", type=float, default=1.0)
+    parser.add_argument("--merge-siblings", action="store_true", help="merge identical sibling calls into n-choice requests")
+    add_fake_arguments(parser)
+    add_governor_arguments(parser)
+    add_scoring_arguments(parser)
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="previous report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown before failing --compare")
+    spec_args, _ = parser.parse_known_args()
+    if spec_args.pipeline:
+        mmps.pipeline = load_pipeline(spec_args.pipeline)
+    pipeline = mmps.pipeline
+    parser.set_defaults(**{SCORING_DEFAULTS[key]: value for key, value in pipeline.scoring.items()})
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    args.iterations = args.iterations or [pipeline.iterations]
+    args.schedule = args.schedule or [(pipeline.max_tokens["start"], pipeline.max_tokens["step"], pipeline.final_tokens)]
+    if args.prompts:
+        pool = [user_prompt for _, user_prompt in mmps.read_prompts(args.prompts)]
+    else:
+        pool = [f"Write a function in Python number {i} that applies a reverb effect to a stereo wave file."
+                for i in range(args.jobs)]
+    prompts = [pool[i % len(pool)] for i in range(args.jobs)]
+
+    runs = []
+    for iterations in args.iterations:
+        for concurrency in args.concurrency:
+            for schedule in args.schedule:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    run = executor.submit(measure_config, args, prompts, iterations, concurrency, schedule).result()
+                runs.append(run)
+                job = run["latency"]["job"]
+                print(f"iterations={iterations} concurrency={concurrency} schedule={':'.join(map(str, schedule))}: "
+                      f"{run['jobs_per_minute']} jobs/min, job p50={job.get('p50')}s p95={job.get('p95')}s, "
+                      f"{run['failed']} failed")
+
+    report = {
+        "version": git_version(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "backend": {"type": "replay" if args.replay else "fake", **(
+            {"recording": args.replay, "speed": args.replay_speed} if args.replay else
+            {"latency": args.fake_latency, "distribution": args.fake_distribution, "spread": args.fake_spread,
+             "tokens_per_second": args.fake_tps, "failure_rate": args.fake_failure_rate, "seed": args.seed})},
+        "max_in_flight": args.max_in_flight,
+        "merge_siblings": args.merge_siblings,
+        "pipeline": args.pipeline or "default",
+        "scoring": {"mode": args.scoring, "tournament_size": args.tournament_size,
+                    "tournament_advance": args.tournament_advance},
+        "runs": runs,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Performance regressions: {regressions}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
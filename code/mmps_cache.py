@@ -0,0 +1,116 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import logging
+import threading
+import time
+
+from mmps_backends import request_key
+
+
+class ResponseCache:
+    # Persistent cache of model responses keyed by a hash of (model, messages, max_tokens, temperature).
+    # Entries expire after `ttl` seconds and the least recently used ones are evicted once the stored
+    # responses exceed `max_bytes`. Sampled (temperature > 0) calls bypass the cache unless
+    # `cache_sampled` is set, which turns the cache into a deterministic replay store.
+    def __init__(self, path="mmps_cache.sqlite", ttl=7 * 24 * 3600, max_bytes=256 * 1024 * 1024, cache_sampled=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.lock = threading.Lock()
+        # Imported here so that runs without --cache do not pay for sqlite3
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                        "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                        "created REAL NOT NULL, accessed REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(model, messages, max_tokens, temperature, options=None):
+        # The same key as recordings (RecordingBackend), so existing cache files stay valid
+        return request_key(messages, model, max_tokens, temperature, options)
+
+    def lookup(self, model, messages, max_tokens, temperature, options=None, sampled=False):
+        # Returns (key, response); key is None when the policy bypasses the cache for this call.
+        # `sampled` caches this call even if it has temperature > 0 and cache_sampled is off.
+        if temperature and not (self.cache_sampled or sampled):
+            with self.lock:
+                self.bypassed += 1
+            return None, None
+        key = self.key(model, messages, max_tokens, temperature, options)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._delete(key)
+                row = None
+            if row is None:
+                self.misses += 1
+                return key, None
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        logging.debug("Cache hit for %s", key)
+        return key, row[0]
+
+    def store(self, key, response):
+        if key is None:
+            return
+        size = len(response.encode())
+        now = time.time()
+        with self.lock:
+            self._delete(key)
+            self.db.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?)", (key, response, size, now, now))
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _delete(self, key):
+        row = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= row[0]
+
+    def _evict(self):
+        # Other processes may share the file, so re-read the real size before evicting
+        self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        rows = self.db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logging.info("Cache evicted %s entries, %s bytes left", len(evicted), self.total_bytes)
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "bypassed": self.bypassed,
+                    "entries": entries, "bytes": self.total_bytes}
+
+    def close(self):
+        self.db.close()
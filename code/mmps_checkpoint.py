@@ -0,0 +1,137 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import json
+import os
+import threading
+import time
+
+
+class Checkpoint:
+    # What a checkpoint file holds for one job: the prompt and the layer records keyed by (iteration, layer
+    # number)
+    def __init__(self, job, prompt=None, fingerprint=None):
+        self.job = job
+        self.prompt = prompt
+        self.fingerprint = fingerprint
+        self.layers = {}
+
+
+class CheckpointStore:
+    # Append-only JSONL file per unfinished job, named after its job id: the prompt hash for batch and
+    # interactive jobs, the job's id on the server. Every job has a file of its own, so two jobs with the
+    # same prompt never write to the same one. Every finished layer call is written as one line with its
+    # output and parameters (model, temperature, max_tokens) and flushed right away, so a job that fails or
+    # is interrupted loses at most the calls that were in flight. A torn last line of a crashed process is
+    # skipped when the file is read back. A "job" line starts the records of one pipeline; when the pipeline
+    # changes, a new one is appended and the earlier records are ignored. The file is deleted once the job
+    # finishes, so a finished job is never resumed and running the prompt again starts afresh.
+    def __init__(self, directory="checkpoints", fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, job):
+        return os.path.join(self.directory, f"{job}.jsonl")
+
+    def find(self, name):
+        # Resolves a prompt hash, a unique prefix of one or a checkpoint file path to the job's hash
+        if os.path.isfile(name):
+            return os.path.splitext(os.path.basename(name))[0]
+        matches = [entry[:-len(".jsonl")] for entry in os.listdir(self.directory)
+                   if entry.startswith(name) and entry.endswith(".jsonl")]
+        if len(matches) != 1:
+            raise KeyError(f"{len(matches)} checkpoints in {self.directory} match {name!r}")
+        return matches[0]
+
+    def _append(self, job, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            f = self.files.get(job)
+            if f is None:
+                f = self.files[job] = open(self.path(job), "a+", encoding="utf-8")
+                # A crash can leave a torn last line; end it so the next record starts on a line of its own
+                if f.tell():
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != "\n":
+                        f.write("\n")
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def start(self, job, prompt, fingerprint, checkpoint=None):
+        # The "job" line names the prompt, so that --resume only needs the hash. `checkpoint` is what
+        # load() returned for the job.
+        if checkpoint is None or checkpoint.fingerprint != fingerprint:
+            self._append(job, {"type": "job", "prompt": prompt, "fingerprint": fingerprint, "time": time.time()})
+
+    def layer(self, job, iteration, layer, text, params, duration=None):
+        self._append(job, dict({"type": "layer", "iteration": iteration, "layer": layer, "text": text,
+                                "duration": duration}, **params))
+
+    def finish(self, job):
+        self.release(job)
+        try:
+            os.remove(self.path(job))
+        except FileNotFoundError:
+            pass
+
+    def release(self, job):
+        with self.lock:
+            f = self.files.pop(job, None)
+        if f is not None:
+            f.close()
+
+    def load(self, job):
+        # Returns the job's Checkpoint with the records of its latest pipeline, or None when there is none
+        if not os.path.exists(self.path(job)):
+            return None
+        checkpoint = Checkpoint(job)
+        with open(self.path(job), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line of an interrupted write
+                if record["type"] == "job":
+                    if record["fingerprint"] != checkpoint.fingerprint:
+                        checkpoint = Checkpoint(job, record["prompt"], record["fingerprint"])
+                elif record["type"] == "layer":
+                    checkpoint.layers[(record["iteration"], record["layer"])] = record
+        return checkpoint
+
+    def close(self):
+        with self.lock:
+            files, self.files = list(self.files.values()), {}
+        for f in files:
+            f.close()
+
+
+def add_checkpoint_arguments(parser):
+    parser.add_argument("--checkpoint-dir", metavar="DIR",
+                        help="write every finished layer output to DIR/<job id>.jsonl and resume unfinished jobs from it")
+    parser.add_argument("--checkpoint-fsync", action="store_true",
+                        help="fsync every checkpoint line (survives power loss, not only process crashes)")
+
+
+def checkpoints_from_args(args):
+    if not args.checkpoint_dir:
+        return None
+    return CheckpointStore(args.checkpoint_dir, fsync=args.checkpoint_fsync)
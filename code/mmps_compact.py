@@ -0,0 +1,216 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import functools
+import logging
+import random
+import re
+import threading
+import zlib
+
+from mmps_backends import estimate_tokens
+
+# Mersenne prime used for the MinHash permutations (a * h + b) % MINHASH_PRIME
+MINHASH_PRIME = (1 << 61) - 1
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+WORD = re.compile(r"\w+")
+# Opening or closing line of a fenced code block
+FENCE = re.compile(r"\s*(```|~~~)")
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    # tiktoken is optional; without it token counts fall back to the characters/4 estimate
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model="gpt-4o"):
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def split_sentences(text):
+    # Returns (verbatim, sentences) per line, so the layout of lists and paragraphs survives compaction.
+    # Blank and indented lines and fenced code blocks, fences included, are verbatim: kept whole as one
+    # "sentence" and never deduplicated, so code and pseudo-code keep their indentation and repeated lines.
+    lines = []
+    fenced = False
+    for line in text.splitlines():
+        if FENCE.match(line):
+            fenced = not fenced
+            lines.append((True, [line]))
+        elif fenced or not line.strip() or line[0].isspace():
+            lines.append((True, [line]))
+        else:
+            lines.append((False, [s for s in SENTENCE_END.split(line.strip()) if s]))
+    return lines
+
+
+def shingles(sentence, size=3):
+    # crc32 instead of hash() so compaction, and therefore the cache key of the compacted prompt, is
+    # the same in every process
+    words = WORD.findall(sentence.lower())
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode())}
+    return {zlib.crc32(" ".join(words[i:i + size]).encode()) for i in range(len(words) - size + 1)}
+
+
+class Compactor:
+    # Shrinks the context passed to layers 3-5. Prose sentences of at least `min_words` words that are
+    # near duplicates (estimated Jaccard similarity of their word shingles >= `threshold`, via MinHash with
+    # LSH banding) of an earlier sentence are dropped; code and shorter sentences are kept as they are. If
+    # the remaining context is still over `budget` tokens, sentences are packed round-robin across the
+    # sources, so each source keeps its leading sentences, until the budget is used.
+    # Every iteration summarizes only its own layer 3 and 4 answers, so duplicates are looked for within
+    # one call's context, never across iterations: feeding one iteration the answers of the others would
+    # make each summary wait for the slowest iteration and break per-iteration resume and warm starts.
+    def __init__(self, budget=None, threshold=0.8, min_words=8, shingle_size=3, permutations=64, bands=16,
+                 model="gpt-4o"):
+        self.budget = budget
+        self.threshold = threshold
+        self.min_words = min_words
+        self.shingle_size = shingle_size
+        self.bands = bands
+        self.rows = permutations // bands
+        self.model = model
+        rng = random.Random(permutations)
+        self.permutations = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME))
+                             for _ in range(self.rows * bands)]
+        self.lock = threading.Lock()
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.duplicates = 0
+        self.over_budget = 0
+
+    def signature(self, sentence):
+        hashes = shingles(sentence, self.shingle_size)
+        return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in self.permutations)
+
+    def deduplicate(self, texts):
+        # Returns the sentences of every line of every text with near duplicates removed, and how many were
+        buckets = {}
+        kept = []
+        documents = []
+        removed = 0
+        for text in texts:
+            lines = []
+            for verbatim, line in split_sentences(text):
+                if verbatim:
+                    lines.append((verbatim, line))
+                    continue
+                sentences = []
+                for sentence in line:
+                    if len(WORD.findall(sentence)) < self.min_words:
+                        sentences.append(sentence)
+                        continue
+                    signature = self.signature(sentence)
+                    bands = [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+                    candidates = {index for band in bands for index in buckets.get(band, ())}
+                    if any(self._similarity(signature, kept[index]) >= self.threshold for index in candidates):
+                        removed += 1
+                        continue
+                    for band in bands:
+                        buckets.setdefault(band, []).append(len(kept))
+                    kept.append(signature)
+                    sentences.append(sentence)
+                lines.append((verbatim, sentences))
+            documents.append(lines)
+        return documents, removed
+
+    @staticmethod
+    def _similarity(a, b):
+        return sum(x == y for x, y in zip(a, b)) / len(a)
+
+    def pack(self, texts, reserved=0):
+        # Compacts `texts` so that, together with `reserved` tokens for the rest of the prompt, they fit the
+        # budget. Returns the compacted texts in the same order.
+        tokens_in = sum(count_tokens(text, self.model) for text in texts)
+        if self.threshold is None:
+            documents = [split_sentences(text) for text in texts]
+            removed = 0
+        else:
+            documents, removed = self.deduplicate(texts)
+        sentences = [[(line, sentence, count_tokens(sentence, self.model)) for line, (_, sentences) in enumerate(lines)
+                      for sentence in sentences] for lines in documents]
+        available = None if self.budget is None else max(self.budget - reserved, 0)
+        if available is not None and sum(tokens for doc in sentences for _, _, tokens in doc) > available:
+            sentences = self._fit(sentences, available)
+            over_budget = 1
+        else:
+            over_budget = 0
+        compacted = [self._join(doc) for doc in sentences]
+        tokens_out = sum(count_tokens(text, self.model) for text in compacted)
+        with self.lock:
+            self.tokens_in += tokens_in
+            self.tokens_out += tokens_out
+            self.duplicates += removed
+            self.over_budget += over_budget
+        logging.debug("Compacted context from %s to %s tokens (%s duplicate sentences)", tokens_in, tokens_out, removed)
+        return compacted
+
+    @staticmethod
+    def _fit(documents, available):
+        # Takes sentences round-robin from every document while they fit, skipping ones that are too long
+        kept = [[] for _ in documents]
+        position = [0] * len(documents)
+        used = 0
+        while any(position[i] < len(doc) for i, doc in enumerate(documents)):
+            for i, doc in enumerate(documents):
+                if position[i] < len(doc):
+                    item = doc[position[i]]
+                    position[i] += 1
+                    if used + item[2] <= available:
+                        kept[i].append(item)
+                        used += item[2]
+        return kept
+
+    @staticmethod
+    def _join(sentences):
+        lines = {}
+        for line, sentence, _ in sentences:
+            lines.setdefault(line, []).append(sentence)
+        return "\n".join(" ".join(lines[line]) for line in sorted(lines))
+
+    def stats(self):
+        with self.lock:
+            return {"tokens_in": self.tokens_in, "tokens_out": self.tokens_out, "duplicates": self.duplicates,
+                    "over_budget": self.over_budget}
+
+
+def add_compaction_arguments(parser):
+    parser.add_argument("--compact", action="store_true",
+                        help="deduplicate the prose of the layer 3-5 context and pack it to --input-budget")
+    parser.add_argument("--input-budget", type=int, help="maximum input tokens of the layer 3-5 prompts")
+    parser.add_argument("--dedup-threshold", type=float, default=0.8,
+                        help="drop context sentences at least this similar to an earlier one")
+    parser.add_argument("--dedup-min-words", type=int, default=8,
+                        help="shorter sentences are never dropped as duplicates")
+
+
+def compactor_from_args(args):
+    if not args.compact:
+        return None
+    return Compactor(budget=args.input_budget, threshold=args.dedup_threshold, min_words=args.dedup_min_words)
@@ -0,0 +1,69 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+class IterationController:
+    # Decides, after each wave of scored iterations, whether another wave is worth running. It stops when
+    # the best score reaches `threshold`, when the last wave improved the best score by less than
+    # `min_gain`, at `max_iterations`, or when another wave would exceed the job's token or time budget.
+    # Holds no per-job state, so one controller can serve every job of a batch.
+    def __init__(self, threshold=9.0, min_gain=0.5, min_iterations=1, max_iterations=6, parallel=1,
+                 token_budget=None, time_budget=None):
+        self.threshold = threshold
+        self.min_gain = min_gain
+        self.min_iterations = min_iterations
+        self.max_iterations = max_iterations
+        self.parallel = parallel
+        self.token_budget = token_budget
+        self.time_budget = time_budget
+
+    def next_wave(self, scores, waves, tokens, elapsed):
+        # Returns (number of iterations to start now, stop reason); the number is 0 once the job is done
+        done = len(scores)
+        wave = min(self.parallel, self.max_iterations - done)
+        if done < self.min_iterations:
+            return max(wave, self.min_iterations - done), None
+        if wave <= 0:
+            return 0, "max_iterations"
+        best = max(scores)
+        if best >= self.threshold:
+            return 0, "threshold"
+        previous = scores[:-waves[-1]] if waves else []
+        if previous and best - max(previous) < self.min_gain:
+            return 0, "no_gain"
+        if self.token_budget and tokens + tokens / done * wave > self.token_budget:
+            return 0, "token_budget"
+        if self.time_budget and elapsed + elapsed / len(waves) > self.time_budget:
+            return 0, "time_budget"
+        return wave, None
+
+
+def add_controller_arguments(parser):
+    parser.add_argument("--adaptive", action="store_true", help="stop or extend the iterations depending on the scores")
+    parser.add_argument("--score-threshold", type=float, default=9.0, help="stop as soon as a candidate scores this")
+    parser.add_argument("--min-gain", type=float, default=0.5, help="stop when a wave improves the best score by less")
+    parser.add_argument("--max-iterations", type=int, default=6)
+    parser.add_argument("--parallel-iterations", type=int, default=1, help="iterations started together in each wave")
+    parser.add_argument("--token-budget", type=int, help="maximum prompt+completion tokens per job")
+    parser.add_argument("--time-budget", type=float, help="maximum seconds per job")
+
+
+def controller_from_args(args):
+    if not args.adaptive:
+        return None
+    return IterationController(threshold=args.score_threshold, min_gain=args.min_gain,
+                               max_iterations=args.max_iterations, parallel=args.parallel_iterations,
+                               token_budget=args.token_budget, time_budget=args.time_budget)
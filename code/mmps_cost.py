@@ -0,0 +1,199 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import contextvars
+import logging
+import threading
+import time
+
+# List prices in USD per million (prompt, completion) tokens; --price adds or overrides models
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+# Ledger of the job the running code belongs to
+current_ledger = contextvars.ContextVar("mmps_ledger", default=None)
+
+_unpriced = set()
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def call_cost(prices, model, prompt_tokens, completion_tokens):
+    # Dated snapshots such as gpt-4o-mini-2024-07-18 use the price of the longest matching model name
+    price = prices.get(model)
+    if price is None:
+        names = [name for name in prices if model.startswith(name)]
+        price = prices[max(names, key=len)] if names else None
+    if price is None:
+        if model not in _unpriced:
+            _unpriced.add(model)
+            logging.warning("No price for model '%s', its calls are counted as free", model)
+        return 0.0
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6
+
+
+class Usage:
+    __slots__ = ("calls", "cached", "prompt_tokens", "completion_tokens", "cost", "seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.cached = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.seconds = 0.0
+
+    def add(self, prompt_tokens, completion_tokens, cost, seconds, cached):
+        self.calls += 1
+        self.cached += cached
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost += cost
+        self.seconds += seconds
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def to_dict(self):
+        return {"calls": self.calls, "cached": self.cached, "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens, "cost": round(self.cost, 6),
+                "seconds": round(self.seconds, 3)}
+
+
+class Budget:
+    # Hard limits of one job; None leaves a limit out
+    def __init__(self, max_tokens=None, max_dollars=None, max_seconds=None):
+        self.max_tokens = max_tokens
+        self.max_dollars = max_dollars
+        self.max_seconds = max_seconds
+
+    def __bool__(self):
+        return any(limit is not None for limit in (self.max_tokens, self.max_dollars, self.max_seconds))
+
+    def exceeded(self, tokens, cost, elapsed):
+        # The limit that has been reached, or None
+        if self.max_tokens is not None and tokens >= self.max_tokens:
+            return "token_budget"
+        if self.max_dollars is not None and cost >= self.max_dollars:
+            return "dollar_budget"
+        if self.max_seconds is not None and elapsed >= self.max_seconds:
+            return "time_budget"
+        return None
+
+
+class Ledger:
+    # Usage of one job: every model call with its tokens, cost and latency, rolled up per layer, iteration
+    # and model. Calls are added from coroutines or scheduler threads. Once the budget is reached
+    # `on_exceeded` is called (once), and the finished candidates let the job return the best one so far.
+    def __init__(self, budget=None):
+        self.budget = budget or Budget()
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.total = Usage()
+        self.layers = {}
+        self.iterations = {}
+        self.models = {}
+        self.candidates = {}
+        self.exceeded = None
+        self.on_exceeded = None
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def remaining_seconds(self):
+        if self.budget.max_seconds is None:
+            return None
+        return max(0.0, self.budget.max_seconds - self.elapsed())
+
+    def add(self, model, prompt_tokens, completion_tokens, cost, seconds, layer=None, iteration=None, cached=False):
+        with self.lock:
+            usages = [self.total, self.models.setdefault(model, Usage())]
+            if layer is not None:
+                usages.append(self.layers.setdefault(layer, Usage()))
+            if iteration is not None:
+                usages.append(self.iterations.setdefault(iteration, Usage()))
+            for usage in usages:
+                usage.add(prompt_tokens, completion_tokens, cost, seconds, cached)
+            reason = None
+            if self.exceeded is None:
+                reason = self.exceeded = self.budget.exceeded(self.total.total_tokens, self.total.cost, self.elapsed())
+        if reason:
+            logging.warning("Job %s reached: %s tokens, $%.4f, %.1fs", reason, self.total.total_tokens,
+                            self.total.cost, self.elapsed())
+            if self.on_exceeded:
+                self.on_exceeded()
+
+    def check(self):
+        # Called before a model call: no new calls once a limit has been reached
+        with self.lock:
+            if self.exceeded is None:
+                self.exceeded = self.budget.exceeded(self.total.total_tokens, self.total.cost, self.elapsed())
+            reason = self.exceeded
+        if reason:
+            raise BudgetExceeded(reason)
+
+    def offer(self, iteration, answer, score=None):
+        with self.lock:
+            self.candidates[iteration] = (answer, score)
+
+    def best(self):
+        # (answer, score) of the best scored candidate; unscored ones come after, lowest iteration first
+        with self.lock:
+            candidates = sorted(self.candidates.items())
+        scored = [(score, -iteration, answer) for iteration, (answer, score) in candidates if score is not None]
+        if scored:
+            score, _, answer = max(scored)
+            return answer, score
+        if candidates:
+            return candidates[0][1][0], None
+        return None, None
+
+    def summary(self):
+        with self.lock:
+            return dict(self.total.to_dict(), elapsed=round(self.elapsed(), 3),
+                        layers={str(key): usage.to_dict() for key, usage in self.layers.items()},
+                        iterations={str(key): usage.to_dict() for key, usage in sorted(self.iterations.items())},
+                        models={key: usage.to_dict() for key, usage in self.models.items()})
+
+
+def parse_price(text):
+    model, _, prices = text.partition("=")
+    prompt, completion = (float(value) for value in prices.split(":"))
+    return model, (prompt, completion)
+
+
+def add_cost_arguments(parser):
+    parser.add_argument("--price", type=parse_price, action="append", metavar="MODEL=PROMPT:COMPLETION",
+                        help="USD per million prompt and completion tokens of a model (repeatable)")
+    parser.add_argument("--max-job-tokens", type=int, help="stop a job once its calls used this many tokens")
+    parser.add_argument("--max-job-dollars", type=float, help="stop a job once its calls cost this much")
+    parser.add_argument("--max-job-seconds", type=float, help="stop a job after this many seconds")
+
+
+def prices_from_args(args):
+    prices = dict(PRICES)
+    prices.update(args.price or [])
+    return prices
+
+
+def budget_from_args(args):
+    return Budget(args.max_job_tokens, args.max_job_dollars, args.max_job_seconds)
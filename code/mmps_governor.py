@@ -0,0 +1,362 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from mmps_backends import BackendError, acomplete_choices, complete_choices, estimate_tokens
+
+# Requests and tokens per minute of each model (OpenAI tier 1); limits reported in response headers take over
+DEFAULT_LIMITS = {
+    "gpt-4o-mini": (500, 200000),
+    "gpt-4o": (500, 30000),
+}
+
+# Statuses worth retrying: timeouts, rate limits and transient server errors
+RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+
+
+def request_tokens(messages, max_tokens):
+    # The API charges prompt tokens plus max_tokens against the TPM limit when a request arrives
+    return sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+
+
+def parse_duration(text):
+    # Rate-limit reset headers look like "1s", "6m0s", "20ms" or "0.5"
+    if text is None:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", text)
+    if not parts:
+        try:
+            return float(text)
+        except ValueError:
+            return None
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+class TokenBucket:
+    def __init__(self, capacity, per_second):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        # Takes `amount` right away, going into debt if needed, and returns the seconds until the debt is
+        # paid off. Callers are therefore served in the order they asked.
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.per_second
+
+    def limit(self, remaining, now):
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class RateGovernor:
+    # Shared by every job of the process: per-model request and token buckets, limits learned from
+    # x-ratelimit-* headers, and a per-model pause after a 429 so waiting callers do not all retry at once.
+    # Its methods only take a short in-process lock, so they can run on an event loop.
+    blocking = False
+
+    def __init__(self, limits=None, max_retries=6, base_delay=1.0, max_delay=60.0, seed=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.paused_until = {}
+        self.stats = {"calls": 0, "retries": 0, "throttled_seconds": 0.0}
+        for model, (rpm, tpm) in (limits or {}).items():
+            self.set_limits(model, rpm, tpm)
+
+    def set_limits(self, model, rpm, tpm):
+        with self.lock:
+            self.buckets[model] = (TokenBucket(rpm, rpm / 60), TokenBucket(tpm, tpm / 60))
+
+    def reserve(self, model, tokens):
+        # Returns how long the caller has to wait before sending a request of `tokens` tokens
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.paused_until.get(model, 0.0) - now)
+            if model in self.buckets:
+                requests, token_bucket = self.buckets[model]
+                delay = max(delay, requests.reserve(1, now), token_bucket.reserve(tokens, now))
+            self.stats["calls"] += 1
+            self.stats["throttled_seconds"] += delay
+            return delay
+
+    def observe(self, model, headers):
+        if not headers:
+            return
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_requests and limit_tokens:
+            rpm, tpm = int(limit_requests), int(limit_tokens)
+            current = self.buckets.get(model)
+            if current is None or (current[0].capacity, current[1].capacity) != (rpm, tpm):
+                logging.info("Rate limits of '%s' from headers: %s requests/min, %s tokens/min", model, rpm, tpm)
+                self.set_limits(model, rpm, tpm)
+        with self.lock:
+            if model not in self.buckets:
+                return
+            now = time.monotonic()
+            requests, token_bucket = self.buckets[model]
+            for bucket, name in ((requests, "requests"), (token_bucket, "tokens")):
+                remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                if remaining is not None:
+                    bucket.limit(int(remaining), now)
+                    reset = parse_duration(headers.get(f"x-ratelimit-reset-{name}"))
+                    if int(remaining) == 0 and reset:
+                        self.paused_until[model] = max(self.paused_until.get(model, 0.0), now + reset)
+
+    def retry_delay(self, model, error, attempt):
+        # Jittered exponential backoff for a failed call, or None when it should not be retried
+        status = getattr(error, "status", None)
+        if status not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+            return None
+        headers = getattr(error, "headers", None) or {}
+        self.observe(model, headers)
+        with self.lock:
+            delay = self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            retry_after = parse_duration(headers.get("retry-after"))
+            if retry_after:
+                delay = max(delay, retry_after)
+            if status == 429:
+                now = time.monotonic()
+                self.paused_until[model] = max(self.paused_until.get(model, 0.0), now + delay)
+            self.stats["retries"] += 1
+        logging.warning("Call to '%s' failed with status %s (%s), retry %s in %.2fs", model, status, error, attempt + 1,
+                        delay)
+        return delay
+
+
+class SharedRateGovernor(RateGovernor):
+    # RateGovernor whose buckets and pauses live in a SQLite file, so that every process using the file
+    # (the job server's workers, or several batch runs) draws from one budget per model. Each call loads the
+    # model's state, updates it and writes it back in one transaction. Times are stored as wall-clock
+    # time, so the state stays valid across restarts. A call can wait up to the 30 s busy timeout for the
+    # file lock, so GovernedBackend runs them off the event loop.
+    blocking = True
+
+    def __init__(self, path, limits=None, **kwargs):
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS governor (model TEXT PRIMARY KEY, state TEXT NOT NULL)")
+        self.shared_lock = threading.RLock()
+        self.depth = 0
+        super().__init__(limits, **kwargs)
+
+    @contextlib.contextmanager
+    def _shared(self, model):
+        with self.shared_lock:
+            if self.depth:
+                # Nested call, e.g. set_limits() from observe(), inside the outer transaction
+                yield
+                return
+            self.depth = 1
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self._load(model)
+                yield
+                self._save(model)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            finally:
+                self.depth = 0
+
+    def _load(self, model):
+        row = self.db.execute("SELECT state FROM governor WHERE model = ?", (model,)).fetchone()
+        if row is None:
+            return
+        state = json.loads(row[0])
+        offset = time.time() - time.monotonic()
+        with self.lock:
+            if state["buckets"]:
+                buckets = []
+                for capacity, per_second, level, updated in state["buckets"]:
+                    bucket = TokenBucket(capacity, per_second)
+                    bucket.level = level
+                    bucket.updated = updated - offset
+                    buckets.append(bucket)
+                self.buckets[model] = tuple(buckets)
+            self.paused_until[model] = state["paused_until"] - offset
+
+    def _save(self, model):
+        offset = time.time() - time.monotonic()
+        with self.lock:
+            state = {"buckets": [[bucket.capacity, bucket.per_second, bucket.level, bucket.updated + offset]
+                                 for bucket in self.buckets.get(model, ())],
+                     "paused_until": self.paused_until.get(model, 0.0) + offset}
+        self.db.execute("INSERT OR REPLACE INTO governor VALUES (?, ?)", (model, json.dumps(state)))
+
+    def set_limits(self, model, rpm, tpm):
+        # New limits keep what the other processes have already used up
+        with self._shared(model):
+            previous = self.buckets.get(model)
+            super().set_limits(model, rpm, tpm)
+            if previous is not None:
+                with self.lock:
+                    for bucket, old in zip(self.buckets[model], previous):
+                        bucket.level = min(bucket.capacity, old.level)
+                        bucket.updated = old.updated
+
+    def reserve(self, model, tokens):
+        with self._shared(model):
+            return super().reserve(model, tokens)
+
+    def observe(self, model, headers):
+        if not headers:
+            return
+        with self._shared(model):
+            super().observe(model, headers)
+
+    def retry_delay(self, model, error, attempt):
+        with self._shared(model):
+            return super().retry_delay(model, error, attempt)
+
+
+class GovernedBackend:
+    # Backend wrapper that waits for the governor before each call and retries transient failures
+    def __init__(self, backend, governor):
+        self.backend = backend
+        self.governor = governor
+
+    def _call(self, model, tokens, call):
+        for attempt in itertools.count():
+            time.sleep(self.governor.reserve(model, tokens))
+            try:
+                response = call()
+            except BackendError as e:
+                delay = self.governor.retry_delay(model, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.governor.observe(model, (response[0] if isinstance(response, list) else response).headers)
+            return response
+
+    async def _agovern(self, method, *args):
+        # A blocking governor's call runs in a thread, so that waiting for its file lock stalls only this call
+        if self.governor.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def _acall(self, model, tokens, call):
+        for attempt in itertools.count():
+            await asyncio.sleep(await self._agovern(self.governor.reserve, model, tokens))
+            try:
+                response = await call()
+            except BackendError as e:
+                delay = await self._agovern(self.governor.retry_delay, model, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            await self._agovern(self.governor.observe, model,
+                                (response[0] if isinstance(response, list) else response).headers)
+            return response
+
+    def complete(self, messages, model, max_tokens, temperature, **options):
+        return self._call(model, request_tokens(messages, max_tokens),
+                          lambda: self.backend.complete(messages, model, max_tokens, temperature, **options))
+
+    async def acomplete(self, messages, model, max_tokens, temperature, **options):
+        return await self._acall(model, request_tokens(messages, max_tokens),
+                                 lambda: self.backend.acomplete(messages, model, max_tokens, temperature, **options))
+
+    def complete_choices(self, messages, model, max_tokens, temperature, n):
+        # One request against the RPM limit, with every choice's max_tokens against the TPM limit
+        return self._call(model, request_tokens(messages, max_tokens * n),
+                          lambda: complete_choices(self.backend, messages, model, max_tokens, temperature, n))
+
+    async def acomplete_choices(self, messages, model, max_tokens, temperature, n):
+        return await self._acall(model, request_tokens(messages, max_tokens * n),
+                                 lambda: acomplete_choices(self.backend, messages, model, max_tokens, temperature, n))
+
+    def stream(self, messages, model, max_tokens, temperature):
+        # A call is only retried while nothing has been yielded yet; later failures reach the caller
+        tokens = request_tokens(messages, max_tokens)
+        for attempt in itertools.count():
+            time.sleep(self.governor.reserve(model, tokens))
+            started = False
+            try:
+                for delta in self.backend.stream(messages, model, max_tokens, temperature):
+                    started = True
+                    yield delta
+                return
+            except BackendError as e:
+                delay = None if started else self.governor.retry_delay(model, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def astream(self, messages, model, max_tokens, temperature):
+        tokens = request_tokens(messages, max_tokens)
+        for attempt in itertools.count():
+            await asyncio.sleep(await self._agovern(self.governor.reserve, model, tokens))
+            started = False
+            try:
+                async for delta in self.backend.astream(messages, model, max_tokens, temperature):
+                    started = True
+                    yield delta
+                return
+            except BackendError as e:
+                delay = None if started else await self._agovern(self.governor.retry_delay, model, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+
+def parse_rate_limit(text):
+    model, _, limits = text.partition("=")
+    rpm, tpm = (int(value) for value in limits.split(":"))
+    return model, (rpm, tpm)
+
+
+def add_governor_arguments(parser):
+    parser.add_argument("--rate-limit", type=parse_rate_limit, action="append", metavar="MODEL=RPM:TPM",
+                        help="requests and tokens per minute of a model (repeatable)")
+    parser.add_argument("--max-retries", type=int, default=6, help="retries of a failed call, 0 disables retrying")
+    parser.add_argument("--governor-state", metavar="PATH",
+                        help="SQLite file through which several processes share the rate limits and backoff")
+
+
+def governor_from_args(args, default_limits=None):
+    limits = dict(default_limits or {})
+    limits.update(args.rate_limit or [])
+    if getattr(args, "governor_state", None):
+        return SharedRateGovernor(args.governor_state, limits, max_retries=args.max_retries,
+                                  seed=getattr(args, "seed", None))
+    return RateGovernor(limits, max_retries=args.max_retries, seed=getattr(args, "seed", None))
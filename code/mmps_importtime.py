@@ -0,0 +1,71 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Optional or heavy modules that must only be loaded on demand, never by importing the pipeline
+DEFERRED_MODULES = ["openai", "tqdm", "langchain", "langchain_core", "tiktoken", "yaml", "numpy", "http.server",
+                    "sqlite3"]
+
+
+def measure(module):
+    # One fresh interpreter per run; returns {module: (self_us, cumulative_us)} from -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that importing MMPS stays within an import-time budget")
+    parser.add_argument("--module", default="mmps", help="module to import")
+    parser.add_argument("--budget", type=float, default=250.0, help="maximum cumulative import time (ms)")
+    parser.add_argument("--runs", type=int, default=5, help="the fastest of this many runs is compared to the budget")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules to list")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    best = min(runs, key=lambda times: times[args.module][1])
+    total_ms = best[args.module][1] / 1000
+    print(f"import {args.module}: {total_ms:.1f} ms (best of {args.runs}, budget {args.budget:.0f} ms)")
+    for name, (self_us, cumulative_us) in sorted(best.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"  {self_us / 1000:7.1f} ms self {cumulative_us / 1000:7.1f} ms cumulative  {name}")
+
+    failed = False
+    loaded = [name for name in DEFERRED_MODULES if name in best]
+    if loaded:
+        print(f"Loaded at import time but should be deferred: {', '.join(loaded)}")
+        failed = True
+    if total_ms > args.budget:
+        print(f"Import time {total_ms:.1f} ms is over the budget of {args.budget:.0f} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import atexit
+import contextlib
+import contextvars
+import logging
+import os
+import queue
+import random
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+
+# Id of the job the running code belongs to; records are routed to job_<id>.log by it
+current_job = contextvars.ContextVar("mmps_job", default=None)
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener = None
+
+
+class JobContextFilter(logging.Filter):
+    # Runs in the thread that logs: tags each record with the current job and keeps only a
+    # `debug_sample` share of DEBUG records
+    def __init__(self, debug_sample=1.0):
+        super().__init__()
+        self.debug_sample = debug_sample
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and self.debug_sample < 1 and random.random() >= self.debug_sample:
+            return False
+        record.job_id = current_job.get()
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    # Hands records to the listener thread as they are; the message is only built when it is written
+    def prepare(self, record):
+        return record
+
+
+class TruncatingFormatter(logging.Formatter):
+    def __init__(self, fmt=LOG_FORMAT, max_chars=2000):
+        super().__init__(fmt)
+        self.max_chars = max_chars
+
+    def formatMessage(self, record):
+        if self.max_chars and len(record.message) > self.max_chars:
+            extra = len(record.message) - self.max_chars
+            record.message = f"{record.message[:self.max_chars]}... [{extra} more chars]"
+        return super().formatMessage(record)
+
+
+class JobRouter(logging.Handler):
+    # Listener-side handler writing every record to the file of its job (mmps.log outside of jobs).
+    # At most `max_open` files are kept open; the least recently used one is closed first.
+    def __init__(self, directory=".", formatter=None, max_open=32):
+        super().__init__()
+        self.directory = directory
+        self.max_open = max_open
+        self.handlers = OrderedDict()
+        self.setFormatter(formatter or TruncatingFormatter())
+
+    def _handler(self, job_id):
+        name = f"job_{job_id}.log" if job_id else "mmps.log"
+        handler = self.handlers.pop(name, None)
+        if handler is None:
+            handler = logging.FileHandler(os.path.join(self.directory, name), encoding="utf-8")
+            handler.setFormatter(self.formatter)
+        self.handlers[name] = handler
+        if len(self.handlers) > self.max_open:
+            self.handlers.popitem(last=False)[1].close()
+        return handler
+
+    def emit(self, record):
+        self._handler(getattr(record, "job_id", None)).emit(record)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        self.handlers.clear()
+        super().close()
+
+
+def configure_logging(directory=".", level=logging.DEBUG, max_chars=2000, debug_sample=1.0):
+    # Installs the queue-based logging pipeline on the root logger once per process
+    global _listener
+    if _listener is not None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    records = queue.SimpleQueue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(JobContextFilter(debug_sample))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    router = JobRouter(directory, TruncatingFormatter(max_chars=max_chars))
+    _listener = QueueListener(records, router)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    # Writes out the queued records and closes all job files
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+@contextlib.contextmanager
+def job_context(job_id):
+    token = current_job.set(job_id)
+    try:
+        yield
+    finally:
+        current_job.reset(token)
+
+
+def add_logging_arguments(parser):
+    parser.add_argument("--log-dir", default=".", help="directory of the job_<id>.log files")
+    parser.add_argument("--log-max-chars", type=int, default=2000, help="longer log messages are truncated, 0 keeps all")
+    parser.add_argument("--log-debug-sample", type=float, default=1.0, help="share of DEBUG records that is written")
@@ -0,0 +1,209 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import asyncio
+import hashlib
+import json
+import os
+import string
+import threading
+
+from mmps_scoring import SCORING_DEFAULTS
+
+# Field of every template that holds the user's prompt; all other fields name earlier layers
+USER_PROMPT = "user_prompt"
+
+# The built-in pipeline: four gpt-4o-mini layers that refine the user's prompt and a gpt-4o summary
+DEFAULT_PIPELINE = {
+    "iterations": 3,
+    "model": "gpt-4o-mini",
+    "schedule": {
+        # Temperature and max_tokens grow with every iteration; the last layer always gets final_tokens.
+        # Temperature is capped so adaptive runs past three iterations stay in a usable range.
+        "temperature": {"start": 0.3, "step": 0.2, "max": 1.5},
+        "max_tokens": {"start": 100, "step": 200},
+        "final_tokens": 2000,
+    },
+    "layers": [
+        {"name": "keywords",
+         "prompt": "Given the user's input: '{user_prompt}', extract 5 keywords or phrases and provide a one-sentence description for each."},
+        {"name": "analyses",
+         "prompt": "User's input: '{user_prompt}'. Analyze each keyword: {keywords}. Explain how it relates to solving the problem."},
+        {"name": "correlations", "compact": True,
+         "prompt": "Based on user's input: '{user_prompt}', create pairs of keywords from the analyses: {analyses}. Explain how each pair relates to the problem."},
+        {"name": "synthesis", "compact": True,
+         "prompt": "Taking into account the user's input: '{user_prompt}', synthesize and mix the following correlations into a unified explanation: {correlations}. Do not include any code just information how to solve problem."},
+        {"name": "summary", "model": "gpt-4o", "compact": True,
+         "prompt": "With the user's input in mind: '{user_prompt}', summarize the following information into a final, comprehensive response: {correlations} {synthesis}. Do not include any code just information how to solve problem, remove duplicates."},
+    ],
+    "scoring": {"model": "gpt-4o"},
+}
+
+LAYER_FIELDS = {"name", "prompt", "model", "temperature", "max_tokens", "compact", "concurrency", "cache"}
+CACHE_POLICIES = (True, False, "sampled")
+
+
+class Template:
+    # A prompt template with str.format style {fields}, parsed once. Rendering only joins the literal
+    # parts with the field values, and unlike str.format it leaves braces inside the values alone.
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError(f"Format specs are not supported in templates: {text!r}")
+            self.parts.append((literal, field))
+        self.fields = tuple(dict.fromkeys(field for _, field in self.parts if field))
+
+    def render(self, values):
+        return "".join(literal + (values[field] if field else "") for literal, field in self.parts)
+
+
+class _Unlimited:
+    # Stands in for a semaphore when a layer sets no concurrency limit
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+UNLIMITED = _Unlimited()
+
+
+class Layer:
+    # One model call of an iteration. `inputs` are the earlier layers its prompt uses; `temperature` and
+    # `max_tokens` override the schedule; `compact` packs the inputs with the prompt compactor;
+    # `concurrency` caps this layer's calls in flight across all jobs; `cache` is True (the cache's
+    # own policy), False (never cached) or "sampled" (cached even when temperature > 0).
+    def __init__(self, name, prompt, model, temperature=None, max_tokens=None, compact=False, concurrency=None,
+                 cache=True):
+        if cache not in CACHE_POLICIES:
+            raise ValueError(f"Layer '{name}': cache must be one of {CACHE_POLICIES}")
+        self.name = name
+        self.prompt = Template(prompt)
+        self.inputs = tuple(field for field in self.prompt.fields if field != USER_PROMPT)
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.compact = compact
+        self.concurrency = concurrency
+        self.cache = cache
+        self._semaphore = threading.BoundedSemaphore(concurrency) if concurrency else UNLIMITED
+        self._async_semaphores = {}
+
+    @property
+    def independent(self):
+        # Only uses the user's prompt, so it sends the same request in every iteration
+        return not self.inputs
+
+    def limit(self):
+        return self._semaphore
+
+    def alimit(self):
+        # asyncio semaphores are bound to the loop they are first used on, so keep one per loop
+        if not self.concurrency:
+            return UNLIMITED
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_semaphores:
+            self._async_semaphores.clear()
+            self._async_semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return self._async_semaphores[loop]
+
+
+class Pipeline:
+    # A compiled pipeline spec. Layers run in order within an iteration, each as soon as the layers in
+    # its prompt have finished; the last layer's output is the iteration's answer.
+    def __init__(self, spec):
+        unknown = set(spec) - {"iterations", "model", "system", "schedule", "layers", "scoring"}
+        if unknown:
+            raise ValueError(f"Unknown pipeline fields: {sorted(unknown)}")
+        self.iterations = spec.get("iterations", 3)
+        self.system = spec.get("system")
+        self.scoring = dict(spec.get("scoring", {}))
+        unknown = set(self.scoring) - set(SCORING_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown scoring fields: {sorted(unknown)}")
+        schedule = spec.get("schedule", {})
+        self.temperature = dict(DEFAULT_PIPELINE["schedule"]["temperature"], **schedule.get("temperature", {}))
+        self.max_tokens = dict(DEFAULT_PIPELINE["schedule"]["max_tokens"], **schedule.get("max_tokens", {}))
+        self.final_tokens = schedule.get("final_tokens", DEFAULT_PIPELINE["schedule"]["final_tokens"])
+        self.layers = []
+        names = {USER_PROMPT}
+        for number, layer_spec in enumerate(spec.get("layers", ()), 1):
+            unknown = set(layer_spec) - LAYER_FIELDS
+            if unknown:
+                raise ValueError(f"Unknown fields in layer {number}: {sorted(unknown)}")
+            layer = Layer(**dict({"model": spec.get("model", "gpt-4o-mini")}, **layer_spec))
+            if layer.name in names:
+                raise ValueError(f"Duplicate layer name '{layer.name}'")
+            missing = [name for name in layer.inputs if name not in names]
+            if missing:
+                raise ValueError(f"Layer '{layer.name}' uses {missing}, which are not earlier layers")
+            names.add(layer.name)
+            self.layers.append(layer)
+        if not self.layers:
+            raise ValueError("A pipeline needs at least one layer")
+        # Identifies what the layers produce, so stored layer outputs are only reused by the same pipeline
+        layers = [[layer.name, layer.prompt.text, layer.model] for layer in self.layers]
+        self.fingerprint = hashlib.sha256(json.dumps([self.system, layers]).encode()).hexdigest()[:16]
+
+    @property
+    def answer(self):
+        return self.layers[-1]
+
+    def schedule(self, i, max_tokens_start=None, max_tokens_step=None, final_tokens=None):
+        # (temperature, max_tokens, final_tokens) of iteration i; the arguments override the spec
+        temperature = min(self.temperature["start"] + i * self.temperature["step"], self.temperature["max"])
+        max_tokens_start = self.max_tokens["start"] if max_tokens_start is None else max_tokens_start
+        max_tokens_step = self.max_tokens["step"] if max_tokens_step is None else max_tokens_step
+        final_tokens = self.final_tokens if final_tokens is None else final_tokens
+        return round(temperature, 6), max_tokens_start + i * max_tokens_step, final_tokens
+
+    def layer_params(self, layer, temperature, max_tokens, final_tokens):
+        # Temperature and max_tokens of a layer in an iteration with the given schedule
+        if layer.max_tokens is not None:
+            max_tokens = layer.max_tokens
+        elif layer is self.answer:
+            max_tokens = final_tokens
+        return (temperature if layer.temperature is None else layer.temperature), max_tokens
+
+
+def load_pipeline(path):
+    # Reads a pipeline spec from a .toml, .yaml/.yml or .json file
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as f:
+        if extension == ".toml":
+            try:
+                import tomllib
+            except ImportError:
+                import tomli as tomllib
+            spec = tomllib.load(f)
+        elif extension in (".yaml", ".yml"):
+            import yaml
+            spec = yaml.safe_load(f)
+        elif extension == ".json":
+            spec = json.load(f)
+        else:
+            raise ValueError(f"Unknown pipeline file type '{extension}', expected .toml, .yaml, .yml or .json")
+    return Pipeline(spec)
@@ -0,0 +1,214 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# A job is queued, then running in a worker, and ends up done, failed or cancelled
+FINISHED = ("done", "failed", "cancelled")
+
+
+class JobQueue:
+    # Durable job queue in a SQLite file shared by the job server and its worker processes. A worker leases
+    # the jobs it claims and renews the lease while they run. A job whose lease ran out (its worker died) is
+    # handed out again, up to `max_attempts` times, so jobs survive crashes and restarts. Streamed answer
+    # tokens are stored as events that clients read while the job runs.
+    def __init__(self, path="mmps_jobs.sqlite", lease=30.0, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                        "id TEXT PRIMARY KEY, prompt TEXT NOT NULL, options TEXT NOT NULL, status TEXT NOT NULL, "
+                        "result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, "
+                        "cancel INTEGER NOT NULL DEFAULT 0, submitted REAL NOT NULL, started REAL, finished REAL, "
+                        "lease_until REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, submitted)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS events ("
+                        "seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, event TEXT NOT NULL, "
+                        "data TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_job ON events(job_id, seq)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes never claim the same job
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["cancel"] = bool(job["cancel"])
+        return job
+
+    def _get(self, job_id):
+        return self._job(self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def get(self, job_id):
+        with self.lock:
+            return self._get(job_id)
+
+    def submit(self, prompt, job_id=None, **options):
+        # Returns (job, created). Submitting an id that already exists returns that job, so clients can retry.
+        job_id = job_id or os.urandom(8).hex()
+        with self._transaction():
+            job = self._get(job_id)
+            if job is not None:
+                return job, False
+            self.db.execute("INSERT INTO jobs (id, prompt, options, status, submitted) VALUES (?, ?, ?, 'queued', ?)",
+                            (job_id, prompt, json.dumps(options), time.time()))
+            return self._get(job_id), True
+
+    def claim(self, worker):
+        # Leases the oldest job that is queued or whose worker has stopped renewing it, or returns None
+        now = time.time()
+        with self._transaction():
+            while True:
+                row = self.db.execute("SELECT id, attempts FROM jobs WHERE status = 'running' AND lease_until < ? "
+                                      "ORDER BY submitted LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    row = self.db.execute("SELECT id, attempts FROM jobs WHERE status = 'queued' "
+                                          "ORDER BY submitted LIMIT 1").fetchone()
+                if row is None:
+                    return None
+                if row["attempts"] >= self.max_attempts:
+                    logging.warning("Job %s lost its worker %s times, giving up", row["id"], row["attempts"])
+                    self.db.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ?, worker = NULL "
+                                    "WHERE id = ?", (f"worker lost {row['attempts']} times", now, row["id"]))
+                    continue
+                self.db.execute("UPDATE jobs SET status = 'running', worker = ?, started = ?, lease_until = ?, "
+                                "attempts = attempts + 1 WHERE id = ?", (worker, now, now + self.lease, row["id"]))
+                if row["attempts"]:
+                    # Streamed output of the lost attempt is dropped; the event tells clients to drop theirs
+                    self.db.execute("DELETE FROM events WHERE job_id = ?", (row["id"],))
+                    self.db.execute("INSERT INTO events (job_id, event, data) VALUES (?, 'retry', ?)",
+                                    (row["id"], json.dumps({"attempt": row["attempts"] + 1})))
+                return self._get(row["id"])
+
+    def heartbeat(self, worker, job_ids):
+        # Renews the leases of a worker's running jobs and returns the ones a client asked to cancel
+        if not job_ids:
+            return []
+        marks = ",".join("?" * len(job_ids))
+        with self._transaction():
+            self.db.execute(f"UPDATE jobs SET lease_until = ? WHERE worker = ? AND status = 'running' "
+                            f"AND id IN ({marks})", (time.time() + self.lease, worker, *job_ids))
+            rows = self.db.execute(f"SELECT id FROM jobs WHERE worker = ? AND status = 'running' AND cancel = 1 "
+                                   f"AND id IN ({marks})", (worker, *job_ids)).fetchall()
+        return [row["id"] for row in rows]
+
+    def _end(self, job_id, worker, status, result=None, error=None):
+        # Only the worker holding the lease may end a job; a stale worker's result is dropped
+        with self._transaction():
+            updated = self.db.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, "
+                                      "lease_until = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+                                      (status, result, error, time.time(), job_id, worker)).rowcount
+        if not updated:
+            logging.warning("Job %s is no longer leased by %s, dropping its %s result", job_id, worker, status)
+        return bool(updated)
+
+    def finish(self, job_id, worker, record):
+        error = record.get("error")
+        return self._end(job_id, worker, "failed" if error else "done", json.dumps(record), error)
+
+    def cancelled(self, job_id, worker):
+        return self._end(job_id, worker, "cancelled", error="cancelled")
+
+    def release(self, job_id, worker):
+        # Puts a job back in the queue when its worker shuts down; the attempt does not count
+        with self._transaction():
+            self.db.execute("UPDATE jobs SET status = 'queued', worker = NULL, started = NULL, lease_until = NULL, "
+                            "attempts = attempts - 1 WHERE id = ? AND worker = ? AND status = 'running'",
+                            (job_id, worker))
+
+    def cancel(self, job_id):
+        # A queued job is cancelled right away, a running one by its worker at the next heartbeat
+        with self._transaction():
+            job = self._get(job_id)
+            if job is None or job["status"] in FINISHED:
+                return job
+            if job["status"] == "queued":
+                self.db.execute("UPDATE jobs SET status = 'cancelled', error = 'cancelled', finished = ? WHERE id = ?",
+                                (time.time(), job_id))
+            else:
+                self.db.execute("UPDATE jobs SET cancel = 1 WHERE id = ?", (job_id,))
+            return self._get(job_id)
+
+    def jobs(self, status=None, limit=100):
+        # Newest first, without prompts and results
+        query = "SELECT id, status, attempts, worker, submitted, started, finished, error FROM jobs"
+        parameters = ()
+        if status:
+            query += " WHERE status = ?"
+            parameters = (status,)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY submitted DESC LIMIT ?", (*parameters, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def counts(self):
+        with self.lock:
+            rows = self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def add_events(self, job_id, events):
+        if not events:
+            return
+        with self._transaction():
+            self.db.executemany("INSERT INTO events (job_id, event, data) VALUES (?, ?, ?)",
+                                [(job_id, event, json.dumps(data)) for event, data in events])
+
+    def events(self, job_id, after=0):
+        # (seq, event, data) of a job newer than `after`
+        with self.lock:
+            rows = self.db.execute("SELECT seq, event, data FROM events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                                   (job_id, after)).fetchall()
+        return [(seq, event, json.loads(data)) for seq, event, data in rows]
+
+    def purge(self, older_than):
+        # Deletes jobs that finished more than `older_than` seconds ago, with their events
+        before = time.time() - older_than
+        with self._transaction():
+            self.db.execute("DELETE FROM events WHERE job_id IN "
+                            "(SELECT id FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished < ?)",
+                            (before,))
+            removed = self.db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') "
+                                      "AND finished < ?", (before,)).rowcount
+        if removed:
+            logging.info("Purged %s finished jobs", removed)
+        return removed
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,114 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import json
+import math
+import re
+
+MIN_SCORE = 1
+MAX_SCORE = 10
+SCORING_MODES = ("json", "logprobs")
+# Keys of a pipeline spec's [scoring] table and the command line options they set the default of
+SCORING_DEFAULTS = {"mode": "scoring", "model": "scoring_model", "group_size": "tournament_size",
+                    "advance": "tournament_advance"}
+
+
+def score_format(count):
+    # Structured output schema: one {"response": number, "score": 1-10} entry per scored response
+    entry = {"type": "object", "additionalProperties": False, "required": ["response", "score"],
+             "properties": {"response": {"type": "integer"}, "score": {"type": "integer"}}}
+    schema = {"type": "object", "additionalProperties": False, "required": ["scores"],
+              "properties": {"scores": {"type": "array", "items": entry}}}
+    return {"type": "json_schema", "json_schema": {"name": f"scores_{count}", "strict": True, "schema": schema}}
+
+
+def _valid(score):
+    return score if MIN_SCORE <= score <= MAX_SCORE else None
+
+
+def parse_scores(text, count):
+    # Returns one score per response, None where the output holds no valid score for it. JSON entries
+    # are matched by response number; a plain list of numbers is only accepted with exactly one number
+    # per response, so a score is never paired with the wrong response.
+    scores = [None] * count
+    try:
+        for entry in json.loads(text)["scores"]:
+            index = int(entry["response"]) - 1
+            if 0 <= index < count:
+                scores[index] = _valid(float(entry["score"]))
+        return scores
+    except (ValueError, KeyError, TypeError):
+        pass
+    numbers = re.findall(r"\d+(?:\.\d+)?", text)
+    if len(numbers) == count:
+        return [_valid(float(number)) for number in numbers]
+    if count == 1 and numbers:
+        # A single response can't be mispaired; "Response 1: 7" ends with its score
+        return [_valid(float(numbers[-1]))]
+    return scores
+
+
+def expected_score(logprobs):
+    # Probability-weighted mean over the score tokens among the most likely first tokens, renormalised
+    # to their share of the probability mass; None when no score token is among them
+    weights = {}
+    for token, logprob in (logprobs or {}).items():
+        token = token.strip()
+        if token.isdigit() and _valid(int(token)) is not None:
+            weights[int(token)] = weights.get(int(token), 0.0) + math.exp(logprob)
+    total = sum(weights.values())
+    if not total:
+        return None
+    return round(sum(score * weight for score, weight in weights.items()) / total, 2)
+
+
+class Scorer:
+    # How the final answers are scored. "json" scores a group of responses in one call with structured
+    # output; "logprobs" scores every response on its own as the expected value of the score token.
+    # Pools larger than `group_size` are scored as a tournament: the pool is split into groups of
+    # `group_size`, the best `advance` of each group go on to the next round, and the last group left
+    # is scored together. group_size=2 and advance=1 gives a pairwise knockout.
+    def __init__(self, mode="json", group_size=8, advance=2, model="gpt-4o"):
+        if mode not in SCORING_MODES:
+            raise ValueError(f"Unknown scoring mode '{mode}', expected one of {SCORING_MODES}")
+        if not 0 < advance < group_size:
+            raise ValueError("A tournament must advance fewer responses than it scores per group")
+        self.mode = mode
+        self.group_size = group_size
+        self.advance = advance
+        self.model = model
+
+    def groups(self, indices):
+        return [indices[i:i + self.group_size] for i in range(0, len(indices), self.group_size)]
+
+    def winners(self, group, scores):
+        # Responses without a valid score rank last; ties keep the earlier response
+        ranked = sorted(zip(group, scores), key=lambda x: -(x[1] or 0))
+        return [index for index, _ in ranked[:self.advance]]
+
+
+def add_scoring_arguments(parser):
+    parser.add_argument("--scoring", choices=SCORING_MODES, default="json",
+                        help="structured JSON scores, or expected scores from the logprobs of the score token")
+    parser.add_argument("--tournament-size", type=int, default=8, help="score larger pools in groups of this size")
+    parser.add_argument("--tournament-advance", type=int, default=2, help="responses of each group that reach the next round")
+    parser.add_argument("--scoring-model", default="gpt-4o")
+
+
+def scorer_from_args(args):
+    return Scorer(mode=args.scoring, group_size=args.tournament_size, advance=args.tournament_advance,
+                  model=args.scoring_model)
@@ -0,0 +1,235 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import array
+import json
+import logging
+import math
+import re
+import threading
+import time
+import zlib
+
+# Words that say little about the task itself; left out of the word features
+STOP_WORDS = frozenset("a an and are as at be by can could do for from how i in into is it me my of on or please "
+                       "should so that the this to use using what with would you your".split())
+
+# Words that reverse the meaning of the word after them, which is then a feature of its own ("without numpy"
+# shares no word feature with "using numpy"); words ending in n't count as well
+NEGATIONS = frozenset("no not non nor never without except avoid cannot".split())
+
+# A word's character trigrams count this much next to the word itself, so close word forms and typos still overlap
+CHAR_WEIGHT = 0.5
+
+
+def _numpy():
+    # NumPy makes a lookup one matrix-vector product; without it the index falls back to plain Python
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def normalize(prompt):
+    # The form in which prompts are compared for an exact match
+    return " ".join(prompt.split())
+
+
+def features(text):
+    # Counts of the word unigrams and bigrams and of the character trigrams of each word. Symbols stay part
+    # of a word, so "c", "c++" and "c#" differ; a negated word only counts as such, without its trigrams.
+    words = re.findall(r"[a-z0-9+#]+(?:[.'][a-z0-9+#]+)*", text.lower())
+    counts = {}
+    negated = False
+    for word in words:
+        if word in NEGATIONS or word.endswith("n't"):
+            negated = True
+        elif word in STOP_WORDS:
+            continue
+        elif negated:
+            negated = False
+            counts["n:" + word] = counts.get("n:" + word, 0) + 1
+            continue
+        counts["w:" + word] = counts.get("w:" + word, 0) + 1
+        padded = f"<{word}>"
+        for i in range(len(padded) - 2):
+            counts["c:" + padded[i:i + 3]] = counts.get("c:" + padded[i:i + 3], 0) + 1
+    for first, second in zip(words, words[1:]):
+        counts[f"b:{first} {second}"] = counts.get(f"b:{first} {second}", 0) + 1
+    return counts
+
+
+def embed(text, dimensions=1024):
+    # Hashed n-gram vector of a prompt as {index: value}, L2-normalized so that the dot product of two vectors
+    # is their cosine similarity. A hash bit picks each feature's sign, so collisions cancel out on average.
+    vector = {}
+    for feature, count in features(text).items():
+        digest = zlib.crc32(feature.encode())
+        weight = CHAR_WEIGHT if feature.startswith("c:") else 1.0
+        sign = 1.0 if digest & 0x80000000 else -1.0
+        index = digest % dimensions
+        vector[index] = vector.get(index, 0.0) + sign * weight * (1 + math.log(count))
+    norm = math.sqrt(sum(value * value for value in vector.values()))
+    return {index: value / norm for index, value in vector.items() if value} if norm else {}
+
+
+class SemanticCache:
+    # Finished jobs indexed by a hashed n-gram vector of their prompt. A new prompt that matches a stored one
+    # of the same pipeline exactly (up to whitespace) gets that job's answer back. A prompt that is only
+    # similar, at least `warm_threshold` (cosine), reuses the stored outputs of every layer but the answer's
+    # and only calls the answer layer and the scoring, since a lexically close prompt can still ask for
+    # something else. The vectors are one in-memory matrix (NumPy when it is installed), persisted with the
+    # results in SQLite; rows stored by other processes are picked up at the next lookup.
+    def __init__(self, path="mmps_semantic.sqlite", warm_threshold=0.9, dimensions=1024, max_entries=10000):
+        self.path = path
+        self.warm_threshold = warm_threshold
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.np = _numpy()
+        self.lock = threading.Lock()
+        # Imported here so that runs without --semantic-cache do not pay for sqlite3
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, fingerprint TEXT NOT NULL, prompt TEXT NOT NULL, "
+                        "vector BLOB NOT NULL, result TEXT NOT NULL, created REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_prompt ON entries (fingerprint, prompt)")
+        self.hits = 0
+        self.warm = 0
+        self.misses = 0
+        self._reset()
+
+    def _reset(self):
+        self.ids = []
+        self.fingerprints = []
+        self.rows = self.np.zeros((0, self.dimensions), dtype=self.np.float32) if self.np else []
+        self.size = 0
+        self.last_id = 0
+
+    def _refresh(self):
+        # Appends the rows stored since the last refresh, by this or any other process
+        new = self.db.execute("SELECT id, fingerprint, vector FROM entries WHERE id > ? ORDER BY id",
+                              (self.last_id,)).fetchall()
+        vectors = []
+        for entry_id, fingerprint, blob in new:
+            self.last_id = entry_id
+            if len(blob) != self.dimensions * 4:
+                continue  # Stored with other --semantic-dimensions
+            self.ids.append(entry_id)
+            self.fingerprints.append(fingerprint)
+            vectors.append(blob)
+        if not vectors:
+            return
+        if self.np:
+            block = self.np.frombuffer(b"".join(vectors), dtype=self.np.float32).reshape(len(vectors), self.dimensions)
+            if self.size + len(vectors) > len(self.rows):
+                # Grow by doubling, so that storing one row at a time stays cheap
+                grown = self.np.zeros((max(2 * len(self.rows), self.size + len(vectors)), self.dimensions),
+                                      dtype=self.np.float32)
+                grown[:self.size] = self.rows[:self.size]
+                self.rows = grown
+            self.rows[self.size:self.size + len(vectors)] = block
+        else:
+            self.rows.extend(array.array("f", blob) for blob in vectors)
+        self.size += len(vectors)
+
+    def _nearest(self, vector, fingerprint):
+        # (similarity, entry id) of the closest stored prompt of the same pipeline
+        if not vector or not self.size:
+            return None, None
+        if self.np:
+            query = self.np.zeros(self.dimensions, dtype=self.np.float32)
+            query[list(vector)] = list(vector.values())
+            similarities = self.rows[:self.size] @ query
+            same = self.np.fromiter((value == fingerprint for value in self.fingerprints), bool, self.size)
+            similarities[~same] = -1.0
+            best = int(similarities.argmax())
+            return float(similarities[best]), self.ids[best] if same[best] else None
+        best_similarity, best_id = None, None
+        for entry_id, value, row in zip(self.ids, self.fingerprints, self.rows):
+            if value == fingerprint:
+                similarity = sum(row[index] * weight for index, weight in vector.items())
+                if best_similarity is None or similarity > best_similarity:
+                    best_similarity, best_id = similarity, entry_id
+        return best_similarity, best_id
+
+    def lookup(self, prompt, fingerprint):
+        # Returns {"id", "similarity", "result", "warm"} of the stored job with the same prompt, else of the
+        # closest one, or None below warm_threshold. "warm" is set when the job should only reuse the layer outputs.
+        with self.lock:
+            row = self.db.execute("SELECT id, result FROM entries WHERE fingerprint = ? AND prompt = ? "
+                                  "ORDER BY id DESC LIMIT 1", (fingerprint, normalize(prompt))).fetchone()
+            if row is not None:
+                self.hits += 1
+                entry_id, similarity, warm, result = row[0], 1.0, False, row[1]
+            else:
+                self._refresh()
+                similarity, entry_id = self._nearest(embed(prompt, self.dimensions), fingerprint)
+                if entry_id is not None and similarity >= self.warm_threshold:
+                    row = self.db.execute("SELECT result FROM entries WHERE id = ?", (entry_id,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self.warm += 1
+                warm, result = True, row[0]
+        logging.info("Semantic cache %s: similarity %.3f to entry %s", "warm start" if warm else "hit",
+                     similarity, entry_id)
+        return {"id": entry_id, "similarity": round(similarity, 4), "result": json.loads(result), "warm": warm}
+
+    def store(self, prompt, fingerprint, result):
+        vector = embed(prompt, self.dimensions)
+        if not vector:
+            return
+        dense = array.array("f", bytes(4 * self.dimensions))
+        for index, value in vector.items():
+            dense[index] = value
+        stored = {key: result[key] for key in ("best_answer", "best_score", "layers")}
+        with self.lock:
+            self.db.execute("INSERT INTO entries (fingerprint, prompt, vector, result, created) VALUES (?, ?, ?, ?, ?)",
+                            (fingerprint, normalize(prompt), dense.tobytes(), json.dumps(stored), time.time()))
+            count = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count > self.max_entries:
+                # Drop the oldest entries and rebuild the matrix without them
+                self.db.execute("DELETE FROM entries WHERE id IN (SELECT id FROM entries ORDER BY id LIMIT ?)",
+                                (count - self.max_entries,))
+                self._reset()
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            return {"hits": self.hits, "warm": self.warm, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        self.db.close()
+
+
+def add_semantic_arguments(parser):
+    parser.add_argument("--semantic-cache", metavar="PATH", help="SQLite file of past jobs looked up by prompt similarity")
+    parser.add_argument("--semantic-warm-threshold", type=float, default=0.9,
+                        help="similarity from which a job reuses a past job's layer outputs and reruns the answer layer")
+    parser.add_argument("--semantic-dimensions", type=int, default=1024, help="size of the hashed prompt vectors")
+    parser.add_argument("--semantic-max-entries", type=int, default=10000, help="oldest past jobs are dropped above this")
+
+
+def semantic_cache_from_args(args):
+    if not args.semantic_cache:
+        return None
+    return SemanticCache(args.semantic_cache, warm_threshold=args.semantic_warm_threshold,
+                         dimensions=args.semantic_dimensions, max_entries=args.semantic_max_entries)
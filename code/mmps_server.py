@@ -0,0 +1,437 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import mmps
+from mmps_logging import configure_logging
+from mmps_queue import FINISHED, JobQueue
+from mmps_stream import QueueSink, sse_event
+from mmps_telemetry import metrics
+
+# Client-chosen job ids end up in URLs and log file names
+JOB_ID = re.compile(r"[A-Za-z0-9._-]{1,128}")
+
+# Most iterations one job may ask for; every iteration is several model calls
+MAX_ITERATIONS = 20
+
+# A worker that exits sooner than this after its start is restarted only once this much time has passed
+RESTART_DELAY = 10.0
+
+# Longest GET /jobs/<id>?wait=... and the interval of SSE keepalive comments (s)
+MAX_WAIT = 60.0
+KEEPALIVE = 15.0
+
+
+def worker_path(path, index):
+    # Per-worker trace and metrics files, so that processes never append to the same file
+    if not path or path == "-":
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{index}{ext}"
+
+
+async def arun_worker(queue, worker, args, backend, controller):
+    # Claims jobs while fewer than --concurrency are running and runs them on this process's event loop.
+    # SIGTERM stops claiming, gives running jobs --drain seconds to finish and puts the rest back in the queue.
+    # Queue calls wait up to SQLite's busy timeout for the file lock, so they run in threads, off the loop
+    # that every job of the worker shares.
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass  # Windows: the worker is terminated and its jobs come back when their leases run out
+    running = {}
+
+    async def run(job):
+        options = job["options"]
+        sink = QueueSink(queue, job["id"]) if options.get("stream") else None
+        try:
+            record = await mmps.arun_job(job["prompt"], job["id"], options.get("iterations") or args.iterations,
+                                         backend, args.score_early, controller, stream=sink)
+        except asyncio.CancelledError:
+            if stop.is_set():
+                await asyncio.to_thread(queue.release, job["id"], worker)
+            else:
+                await asyncio.to_thread(queue.cancelled, job["id"], worker)
+            raise
+        finally:
+            if sink:
+                await asyncio.to_thread(sink.close)
+        await asyncio.to_thread(queue.finish, job["id"], worker, record)
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+
+    def done(task, job_id):
+        running.pop(job_id, None)
+        if not task.cancelled() and task.exception():
+            logging.error("Job %s could not be stored", job_id, exc_info=task.exception())
+
+    async def heartbeat():
+        # A failed renewal is retried at the next beat; the leases are a few beats long
+        while True:
+            await asyncio.sleep(queue.lease / 3)
+            try:
+                cancelled = await asyncio.to_thread(queue.heartbeat, worker, list(running))
+            except Exception:
+                logging.exception("Worker %s could not renew its leases", worker)
+                continue
+            for job_id in cancelled:
+                if job_id in running:
+                    logging.info("Cancelling job %s", job_id)
+                    running[job_id].cancel()
+
+    beat = asyncio.create_task(heartbeat())
+    stopped = asyncio.create_task(stop.wait())
+    while not stop.is_set():
+        while len(running) < args.concurrency:
+            job = await asyncio.to_thread(queue.claim, worker)
+            if job is None:
+                break
+            logging.info("Worker %s claimed job %s (attempt %s)", worker, job["id"], job["attempts"])
+            task = asyncio.create_task(run(job))
+            running[job["id"]] = task
+            task.add_done_callback(lambda task, job_id=job["id"]: done(task, job_id))
+        await asyncio.wait([stopped, *running.values()], timeout=args.poll, return_when=asyncio.FIRST_COMPLETED)
+
+    tasks = list(running.values())
+    if tasks:
+        logging.info("Worker %s stopping, %s jobs running", worker, len(tasks))
+        await asyncio.wait(tasks, timeout=args.drain)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    beat.cancel()
+
+
+def worker_main(args, index):
+    # Entry point of a worker process. Each worker has its own event loop, MAX_IN_FLIGHT limit and backend,
+    # and shares the response cache (--cache) and the rate limits (--governor-state) through SQLite.
+    # Ctrl+C reaches the whole process group; the server stops its workers with SIGTERM instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    args.seed += index
+    args.trace_file = worker_path(args.trace_file, index)
+    args.metrics_file = worker_path(args.metrics_file, index)
+    metrics.labels["worker"] = index
+    backend, governor, controller = mmps.configure(args)
+    queue = JobQueue(args.queue, lease=args.lease, max_attempts=args.max_attempts)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logging.info("Worker %s started", worker)
+    try:
+        asyncio.run(arun_worker(queue, worker, args, backend, controller))
+    finally:
+        mmps.report(args, backend, governor)
+        queue.close()
+
+
+class WorkerPool:
+    # Starts the worker processes and restarts the ones that exit while the server runs
+    def __init__(self, args):
+        self.args = args
+        # Workers start from a fresh interpreter instead of a fork of the server and its threads
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = [None] * args.processes
+        self.started = [0.0] * args.processes
+
+    def _start(self, index):
+        process = self.context.Process(target=worker_main, args=(self.args, index), name=f"mmps-worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self._start(index)
+
+    def check(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or time.monotonic() - self.started[index] < RESTART_DELAY:
+                continue
+            logging.warning("Worker %s exited with code %s, restarting it", index, process.exitcode)
+            self._start(index)
+
+    def alive(self):
+        return sum(process.is_alive() for process in self.processes)
+
+    def stop(self, timeout):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+def validate_job(request):
+    # Returns what is wrong with a submitted job, or None
+    if not isinstance(request, dict):
+        return "Expected a JSON object"
+    if not isinstance(request.get("prompt"), str) or not request["prompt"].strip():
+        return "'prompt' must be a non-empty string"
+    if "id" in request and not (isinstance(request["id"], str) and JOB_ID.fullmatch(request["id"])):
+        return "'id' must be 1-128 letters, digits, '.', '_' or '-'"
+    iterations = request.get("iterations")
+    if iterations is not None and (type(iterations) is not int or not 1 <= iterations <= MAX_ITERATIONS):
+        return f"'iterations' must be an integer from 1 to {MAX_ITERATIONS}"
+    if not isinstance(request.get("stream", False), bool):
+        return "'stream' must be true or false"
+    return None
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    # POST /jobs                  submit {"prompt": ..., "id"?: ..., "iterations"?: ..., "stream"?: true}
+    # GET  /jobs?status=&limit=   list jobs, newest first
+    # GET  /jobs/<id>?wait=<s>    a job with its result, optionally waiting for it to finish
+    # GET  /jobs/<id>/events      server-sent events: status, streamed tokens and candidates, then the result
+    # DELETE /jobs/<id>           cancel a job
+    # GET  /health, /metrics      worker and queue state, as JSON or Prometheus text
+    queue = None
+    pool = None
+    poll = 0.2
+
+    def _route(self):
+        url = urlsplit(self.path)
+        return [part for part in url.path.split("/") if part], parse_qs(url.query)
+
+    def do_POST(self):
+        parts, _ = self._route()
+        if parts != ["jobs"]:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            self._reply(400, {"error": f"Invalid JSON: {e}"})
+            return
+        error = validate_job(request)
+        if error:
+            self._reply(400, {"error": error})
+            return
+        options = {key: request[key] for key in ("iterations", "stream") if request.get(key) is not None}
+        job, created = self.queue.submit(request["prompt"], request.get("id"), **options)
+        if created:
+            logging.info("Job %s queued", job["id"])
+        self._reply(202 if created else 200, job, location=f"/jobs/{job['id']}")
+
+    def do_GET(self):
+        parts, query = self._route()
+        if parts == ["health"]:
+            self._reply(200, {"workers": self.pool.alive(), "processes": len(self.pool.processes),
+                              "jobs": self.queue.counts()})
+        elif parts == ["metrics"]:
+            self._metrics()
+        elif parts == ["jobs"]:
+            status = query.get("status", [None])[0]
+            limit = self._number(query, "limit", "100", int)
+            if limit is not None:
+                self._reply(200, {"jobs": self.queue.jobs(status, limit)})
+        elif len(parts) == 2 and parts[0] == "jobs":
+            wait = self._number(query, "wait", "0", float)
+            if wait is not None:
+                self._job(parts[1], min(MAX_WAIT, wait))
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+            self._events(parts[1])
+        else:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+
+    def _number(self, query, name, default, kind):
+        # A non-negative number from the query string; replies 400 and returns None for anything else
+        value = query.get(name, [default])[0]
+        try:
+            number = kind(value)
+        except ValueError:
+            number = None
+        if number is None or not number >= 0:
+            self._reply(400, {"error": f"Query parameter '{name}' must be a non-negative number, not {value!r}"})
+            return None
+        return number
+
+    def do_DELETE(self):
+        parts, _ = self._route()
+        if len(parts) != 2 or parts[0] != "jobs":
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        job = self.queue.cancel(parts[1])
+        if job is None:
+            self._reply(404, {"error": f"Unknown job {parts[1]}"})
+            return
+        self._reply(200, job)
+
+    def _job(self, job_id, wait):
+        deadline = time.monotonic() + wait
+        job = self.queue.get(job_id)
+        while job is not None and job["status"] not in FINISHED and time.monotonic() < deadline:
+            time.sleep(self.poll)
+            job = self.queue.get(job_id)
+        if job is None:
+            self._reply(404, {"error": f"Unknown job {job_id}"})
+            return
+        self._reply(200, job)
+
+    def _events(self, job_id):
+        job = self.queue.get(job_id)
+        if job is None:
+            self._reply(404, {"error": f"Unknown job {job_id}"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        after = int(self.headers.get("Last-Event-ID") or 0)
+        status = None
+        self.written = time.monotonic()
+        try:
+            while True:
+                # The job is read before its events: a worker stores all events before it ends the job,
+                # so none of them can be missed once the job is seen as finished
+                job = self.queue.get(job_id)
+                for seq, event, data in self.queue.events(job_id, after):
+                    self._write(sse_event(event, data, seq))
+                    after = seq
+                if job is None:
+                    return
+                if job["status"] != status:
+                    status = job["status"]
+                    if status in FINISHED:
+                        self._write(sse_event(status, job))
+                        return
+                    self._write(sse_event("status", {"status": status}))
+                elif time.monotonic() - self.written > KEEPALIVE:
+                    self._write(": keepalive\n\n")
+                time.sleep(self.poll)
+        except (BrokenPipeError, ConnectionResetError):
+            logging.debug("Event stream of job %s closed by the client", job_id)
+
+    def _metrics(self):
+        lines = ["# TYPE mmps_queue_jobs gauge"]
+        lines += [f'mmps_queue_jobs{{status="{status}"}} {count}' for status, count in sorted(self.queue.counts().items())]
+        lines += ["# TYPE mmps_workers gauge", f"mmps_workers {self.pool.alive()}"]
+        payload = ("\n".join(lines) + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _write(self, text):
+        self.wfile.write(text.encode())
+        self.wfile.flush()
+        self.written = time.monotonic()
+
+    def _reply(self, status, body, location=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if location:
+            self.send_header("Location", location)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def make_server(args, queue, pool):
+    handler = type("Handler", (JobHandler,), {"queue": queue, "pool": pool, "poll": args.poll})
+    if not args.socket:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        server.daemon_threads = True
+        return server
+    import socketserver
+
+    class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            # A socket file left behind by an earlier run would make bind() fail
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+            super().server_bind()
+
+    return UnixHTTPServer(args.socket, handler)
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--queue", default="mmps_jobs.sqlite", help="SQLite file of the durable job queue")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", metavar="PATH", help="listen on a Unix socket instead of host:port")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs each worker process runs at once")
+    parser.add_argument("--lease", type=float, default=30.0,
+                        help="seconds after which the job of a worker that stopped renewing it is handed out again")
+    parser.add_argument("--max-attempts", type=int, default=3, help="times a job is handed out before it fails")
+    parser.add_argument("--drain", type=float, default=10.0, help="seconds running jobs get to finish on shutdown")
+    parser.add_argument("--retention", type=float, default=7 * 24 * 3600, help="seconds finished jobs are kept")
+    parser.add_argument("--poll", type=float, default=0.2, help="seconds between queue polls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve MMPS jobs: an HTTP API in front of a durable queue and a pool "
+                                                 "of worker processes")
+    mmps.add_pipeline_arguments(parser)
+    add_server_arguments(parser)
+    args = mmps.parse_args(parser)
+    if not args.governor_state:
+        # The workers always share one rate budget
+        args.governor_state = f"{os.path.splitext(args.queue)[0]}_governor.sqlite"
+    configure_logging(args.log_dir, max_chars=args.log_max_chars, debug_sample=args.log_debug_sample)
+    queue = JobQueue(args.queue, lease=args.lease, max_attempts=args.max_attempts)
+    pool = WorkerPool(args)
+    server = make_server(args, queue, pool)
+    pool.start()
+    threading.Thread(target=server.serve_forever, name="mmps-http", daemon=True).start()
+    address = args.socket or f"http://{args.host}:{server.server_address[1]}"
+    print(f"MMPS job server on {address} with {args.processes} workers, queue {args.queue}", flush=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    purged = 0.0
+    try:
+        while True:
+            time.sleep(1)
+            pool.check()
+            if time.monotonic() - purged > 60:
+                queue.purge(args.retention)
+                purged = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        pool.stop(args.drain + 5)
+        queue.close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StdoutSink:
+    # Prints the layer-5 answers while they are generated. Iterations stream in parallel, so one of them
+    # is shown live and the others are buffered and printed as soon as the live one has finished.
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.done = set()
+        self.printed = set()
+        self.live = None
+
+    def _write(self, text):
+        self.out.write(text)
+        self.out.flush()
+
+    def _go_live(self, iteration):
+        self.live = iteration
+        self.printed.add(iteration)
+        self._write(f"--- Candidate {iteration + 1} ---\n" + "".join(self.buffers[iteration]))
+
+    def _advance(self):
+        # Show waiting candidates, finished ones first, until one of them is still streaming
+        while self.live is None:
+            waiting = [i for i in sorted(self.buffers, key=lambda i: i not in self.done) if i not in self.printed]
+            if not waiting:
+                return
+            self._go_live(waiting[0])
+            if waiting[0] in self.done:
+                self._write("\n\n")
+                self.live = None
+
+    def token(self, iteration, delta):
+        with self.lock:
+            self.buffers.setdefault(iteration, []).append(delta)
+            if self.live == iteration:
+                self._write(delta)
+            self._advance()
+
+    def finished(self, iteration, text):
+        with self.lock:
+            if iteration not in self.buffers:
+                self.buffers[iteration] = [text]
+            self.done.add(iteration)
+            if self.live == iteration:
+                self._write("\n\n")
+                self.live = None
+            self._advance()
+
+
+def sse_event(event, data, event_id=None):
+    # With an id a client that reconnects can send Last-Event-ID to continue where it stopped
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class SSESink:
+    # Writes the layer-5 tokens as server-sent events to `write`, e.g. the wfile of an HTTP handler
+    def __init__(self, write):
+        self.write = write
+        self.lock = threading.Lock()
+
+    def token(self, iteration, delta):
+        with self.lock:
+            self.write(sse_event("token", {"iteration": iteration, "delta": delta}))
+
+    def finished(self, iteration, text):
+        with self.lock:
+            self.write(sse_event("candidate", {"iteration": iteration, "text": text}))
+
+
+class QueueSink:
+    # Stores the layer-5 tokens of a job served by mmps_server.py as events of the job queue. Deltas are
+    # collected and written every `interval` seconds, so a fast stream is not one SQLite write per token.
+    # The writes run in order on a thread of their own, so a busy queue file never blocks the event loop
+    # that streams the tokens; close() waits for them.
+    def __init__(self, queue, job_id, interval=0.1):
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.open = {}
+        self.flushed = time.monotonic()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def token(self, iteration, delta):
+        with self.lock:
+            # One event per iteration and flush, the deltas of the iterations are independent streams
+            pending = self.open.get(iteration)
+            if pending is None:
+                pending = self.open[iteration] = {"iteration": iteration, "delta": ""}
+                self.pending.append(("token", pending))
+            pending["delta"] += delta
+            due = time.monotonic() - self.flushed >= self.interval
+        if due:
+            self.flush()
+
+    def finished(self, iteration, text):
+        with self.lock:
+            self.open.pop(iteration, None)
+            self.pending.append(("candidate", {"iteration": iteration, "text": text}))
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            events, self.pending = self.pending, []
+            self.open = {}
+            self.flushed = time.monotonic()
+        if events:
+            self.writer.submit(self._write, events)
+
+    def _write(self, events):
+        try:
+            self.queue.add_events(self.job_id, events)
+        except Exception:
+            logging.exception("Could not store %s stream events of job %s", len(events), self.job_id)
+
+    def close(self):
+        self.flush()
+        self.writer.shutdown(wait=True)
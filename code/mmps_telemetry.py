@@ -0,0 +1,228 @@
+# Author: Lukasz Zorij
+# Date: 09/20/2024
+# 
+# This code is free to use, but please include the source and copyright information.
+# Copyright (c) 2024 Lukasz Zorij. All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+import contextlib
+import contextvars
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+current_span = contextvars.ContextVar("mmps_span", default=None)
+
+# Attributes a span takes over from its parent, so model calls carry the job, layer and iteration they belong to
+INHERITED_ATTRIBUTES = ("job", "layer", "iteration")
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, math.inf)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "status")
+
+    def __init__(self, name, trace_id, span_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+        self.status = "ok"
+
+    @property
+    def latency(self):
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {"name": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                "start": self.start, "latency": round(self.latency, 6), "status": self.status,
+                "attributes": self.attributes}
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class Metrics:
+    # Process-wide counters and histograms in the Prometheus data model, fed from finished spans.
+    # `labels` are added to every series, e.g. the worker of the job server that wrote the file.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.labels = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def observe_span(self, span):
+        attributes = span.attributes
+        if span.name == "model_call":
+            model = attributes.get("model")
+            layer = attributes.get("layer", "")
+            cache = "hit" if attributes.get("cache_hit") else "miss"
+            self.inc("mmps_model_calls_total", model=model, layer=layer, cache=cache)
+            if span.status != "ok":
+                self.inc("mmps_model_call_errors_total", model=model, error=span.status)
+            elif cache == "miss":
+                self.observe("mmps_model_call_seconds", span.latency, model=model, layer=layer)
+            for kind in ("prompt", "completion"):
+                tokens = attributes.get(f"{kind}_tokens")
+                if tokens:
+                    self.inc("mmps_tokens_total", tokens, model=model, kind=kind)
+            if attributes.get("cost"):
+                self.inc("mmps_cost_dollars_total", attributes["cost"], model=model)
+        elif span.name == "layer":
+            self.observe("mmps_layer_seconds", span.latency, layer=attributes.get("layer", ""))
+        elif span.name == "job":
+            self.inc("mmps_jobs_total", status=span.status)
+            self.observe("mmps_job_seconds", span.latency)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        common = tuple(self.labels.items())
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels + common)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else repr(bound)
+                        lines.append(f"{name}_bucket{_labels(labels + common, ('le', le))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels + common)} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{_labels(labels + common)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # "-" prints to stdout; files are replaced atomically so a scraper never reads half a file
+        text = self.render()
+        if path == "-":
+            sys.stdout.write(text)
+            return
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temporary, path)
+
+
+class JsonlSpanExporter:
+    # Writes every finished span as one JSON line to a file, or to stdout for "-"
+    def __init__(self, path):
+        self.file = sys.stdout if path == "-" else open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            if self.file is not sys.stdout:
+                self.file.close()
+
+
+class Tracer:
+    def __init__(self, metrics, exporter=None):
+        self.metrics = metrics
+        self.exporter = exporter
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        parent = current_span.get()
+        if parent is not None:
+            for key in INHERITED_ATTRIBUTES:
+                if key in parent.attributes:
+                    attributes.setdefault(key, parent.attributes[key])
+        span = Span(name, parent.trace_id if parent else os.urandom(16).hex(), os.urandom(8).hex(),
+                    parent.span_id if parent else None, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = type(e).__name__
+            raise
+        finally:
+            span.end = time.time()
+            current_span.reset(token)
+            self.metrics.observe_span(span)
+            if self.exporter is not None:
+                self.exporter.export(span)
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
+
+
+# Shared by the whole process
+metrics = Metrics()
+tracer = Tracer(metrics)
+
+
+def add_telemetry_arguments(parser):
+    parser.add_argument("--trace-file", help="append every span as a JSON line to this file ('-' for stdout)")
+    parser.add_argument("--metrics-file", help="write Prometheus text metrics to this file ('-' for stdout)")
+
+
+def configure_telemetry(args):
+    if args.trace_file:
+        tracer.exporter = JsonlSpanExporter(args.trace_file)
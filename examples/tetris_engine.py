@@ -0,0 +1,336 @@
+import argparse
+import json
+import random
+import sys
+import time
+
+# Headless Tetris game logic used by tetris-game.py. Every board row is an int bitmask (bit x set when
+# column x is filled), so checking a piece against the board is one AND per piece row. GameBatch steps
+# thousands of games at once on NumPy arrays, and running this file benchmarks both without a display.
+
+GRID_WIDTH = 10
+GRID_HEIGHT = 20
+
+# Tetromino Shapes
+SHAPES = [
+    [[1, 1, 1, 1]],  # I
+    [[1, 1], [1, 1]],  # O
+    [[0, 1, 0], [1, 1, 1]],  # T
+    [[0, 1, 1], [1, 1, 0]],  # S
+    [[1, 1, 0], [0, 1, 1]],  # Z
+    [[1, 0, 0], [1, 1, 1]],  # J
+    [[0, 0, 1], [1, 1, 1]]  # L
+]
+
+# Points per cleared line, multiplied by the level
+LINE_SCORE = 100
+
+# Moves of the benchmark policy and of GameBatch.step
+NOOP, LEFT, RIGHT, ROTATE, DOWN, DROP = range(6)
+
+
+def rotations(shape):
+    # The four clockwise rotations of a shape, the first one as given
+    result = [shape]
+    for _ in range(3):
+        result.append([list(row) for row in zip(*result[-1][::-1])])
+    return result
+
+
+def row_mask(row):
+    return sum(1 << x for x, cell in enumerate(row) if cell)
+
+
+# ROTATIONS[kind][rotation] is (row masks, width) of the piece at column 0; CELLS the (x, y) it covers
+ROTATIONS = [[(tuple(row_mask(row) for row in rotated), len(rotated[0])) for rotated in rotations(shape)]
+             for shape in SHAPES]
+CELLS = [[tuple((x, y) for y, row in enumerate(rotated) for x, cell in enumerate(row) if cell)
+          for rotated in rotations(shape)] for shape in SHAPES]
+
+
+def spawn_x(kind, width=GRID_WIDTH):
+    return width // 2 - ROTATIONS[kind][0][1] // 2
+
+
+class Game:
+    # One game. `colors` holds the kind + 1 of the piece that filled each cell (0 when empty) for drawing;
+    # collisions only look at `rows`.
+    def __init__(self, seed=None, width=GRID_WIDTH, height=GRID_HEIGHT):
+        self.rng = random.Random(seed)
+        self.width = width
+        self.height = height
+        self.full = (1 << width) - 1
+        self.rows = [0] * height
+        self.colors = [bytearray(width) for _ in range(height)]
+        self.score = 0
+        self.lines = 0
+        self.level = 1
+        self.over = False
+        self.next = self.rng.randrange(len(SHAPES))
+        self.spawn()
+
+    def spawn(self):
+        self.kind = self.next
+        self.next = self.rng.randrange(len(SHAPES))
+        self.rotation = 0
+        self.x = spawn_x(self.kind, self.width)
+        self.y = 0
+        if not self.fits(self.rotation, self.x, self.y):
+            self.over = True
+
+    def fits(self, rotation, x, y):
+        masks, width = ROTATIONS[self.kind][rotation]
+        if x < 0 or x + width > self.width:
+            return False
+        rows = self.rows
+        for i, mask in enumerate(masks):
+            row = y + i
+            if row >= self.height or (row >= 0 and rows[row] & (mask << x)):
+                return False
+        return True
+
+    def cells(self):
+        # Board cells covered by the falling piece
+        return [(self.x + x, self.y + y) for x, y in CELLS[self.kind][self.rotation]]
+
+    def move(self, dx):
+        if self.fits(self.rotation, self.x + dx, self.y):
+            self.x += dx
+            return True
+        return False
+
+    def rotate(self):
+        rotation = (self.rotation + 1) % 4
+        if self.fits(rotation, self.x, self.y):
+            self.rotation = rotation
+            return True
+        return False
+
+    def soft_drop(self):
+        if self.fits(self.rotation, self.x, self.y + 1):
+            self.y += 1
+            return True
+        return False
+
+    def step(self):
+        # Gravity: the piece falls one row or locks. Returns the number of lines cleared.
+        if self.soft_drop():
+            return 0
+        return self.lock()
+
+    def drop(self):
+        while self.soft_drop():
+            pass
+        return self.lock()
+
+    def lock(self):
+        # Merges the piece, clears full lines and spawns the next piece. Returns the number of lines cleared.
+        masks, _ = ROTATIONS[self.kind][self.rotation]
+        for i, mask in enumerate(masks):
+            if self.y + i >= 0:
+                self.rows[self.y + i] |= mask << self.x
+        for x, y in self.cells():
+            if y >= 0:
+                self.colors[y][x] = self.kind + 1
+        cleared = self.rows.count(self.full)
+        if cleared:
+            kept = [i for i, row in enumerate(self.rows) if row != self.full]
+            self.rows = [0] * cleared + [self.rows[i] for i in kept]
+            self.colors = [bytearray(self.width) for _ in range(cleared)] + [self.colors[i] for i in kept]
+            self.lines += cleared
+            self.score += cleared * LINE_SCORE * self.level
+        self.spawn()
+        return cleared
+
+    def play(self, action):
+        # One benchmark move: the action, then gravity. A hard drop locks the piece without a gravity step.
+        if action == DROP:
+            return self.drop()
+        if action == LEFT:
+            self.move(-1)
+        elif action == RIGHT:
+            self.move(1)
+        elif action == ROTATE:
+            self.rotate()
+        elif action == DOWN:
+            self.soft_drop()
+        return self.step()
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class GameBatch:
+    # `count` games stepped together, with the same rules and moves as Game.play. Boards are a
+    # (count, height) array of row masks; a finished game starts over on an empty board and is counted
+    # in `games`. The level stays 1.
+    def __init__(self, count, seed=None, width=GRID_WIDTH, height=GRID_HEIGHT):
+        np = _numpy()
+        if np is None:
+            raise ImportError("GameBatch needs NumPy")
+        self.np = np
+        self.rng = np.random.default_rng(seed)
+        self.count = count
+        self.width = width
+        self.height = height
+        self.full = (1 << width) - 1
+        self.masks = np.array([[masks + (0,) * (4 - len(masks)) for masks, _ in kind] for kind in ROTATIONS], np.int32)
+        self.widths = np.array([[width for _, width in kind] for kind in ROTATIONS], np.int32)
+        self.spawn_x = np.array([spawn_x(kind, width) for kind in range(len(SHAPES))], np.int32)
+        self.offsets = np.arange(4)
+        self.boards = np.zeros((count, height), np.int32)
+        self.score = np.zeros(count, np.int64)
+        self.lines = np.zeros(count, np.int64)
+        self.games = 0
+        self.finished_score = 0
+        self.next = self.rng.integers(0, len(SHAPES), count)
+        self.kind = self.next.copy()
+        self.rotation = np.zeros(count, np.int32)
+        self.x = np.zeros(count, np.int32)
+        self.y = np.zeros(count, np.int32)
+        self.spawn(np.arange(count))
+
+    def spawn(self, games):
+        self.kind[games] = self.next[games]
+        self.next[games] = self.rng.integers(0, len(SHAPES), len(games))
+        self.rotation[games] = 0
+        self.x[games] = self.spawn_x[self.kind[games]]
+        self.y[games] = 0
+        over = games[~self.fits(games, self.rotation[games], self.x[games], self.y[games])]
+        if len(over):
+            # Start the finished games over with the piece that did not fit
+            self.games += len(over)
+            self.finished_score += int(self.score[over].sum())
+            self.boards[over] = 0
+            self.score[over] = 0
+            self.lines[over] = 0
+
+    def fits(self, games, rotation, x, y):
+        np = self.np
+        kind = self.kind[games]
+        masks = self.masks[kind, rotation]
+        rows = y[:, None] + self.offsets
+        inside = rows < self.height
+        board_rows = np.take_along_axis(self.boards[games], np.minimum(rows, self.height - 1), 1)
+        hit = np.where(inside, (masks << np.clip(x, 0, self.width)[:, None]) & board_rows, masks)
+        return (x >= 0) & (x + self.widths[kind, rotation] <= self.width) & ~hit.any(1)
+
+    def step(self, actions):
+        # Plays one move in every game and returns the number of lines cleared per game
+        np = self.np
+        games = np.arange(self.count)
+        dx = (actions == RIGHT).astype(np.int32) - (actions == LEFT)
+        rotation = np.where(actions == ROTATE, (self.rotation + 1) % 4, self.rotation)
+        x = self.x + dx
+        moved = self.fits(games, rotation, x, self.y)
+        self.rotation = np.where(moved, rotation, self.rotation)
+        self.x = np.where(moved, x, self.x)
+
+        # A soft drop adds a row to the gravity step and a hard drop falls until it lands
+        distance = np.where(actions == DROP, self.height, 1 + (actions == DOWN))
+        landed = np.zeros(self.count, bool)
+        falling = games
+        while len(falling):
+            fits = self.fits(falling, self.rotation[falling], self.x[falling], self.y[falling] + 1)
+            self.y[falling[fits]] += 1
+            landed[falling[~fits]] = True
+            distance[falling] -= 1
+            falling = falling[fits & (distance[falling] > 0)]
+        cleared = np.zeros(self.count, np.int64)
+        locked = np.flatnonzero(landed)
+        if len(locked):
+            cleared[locked] = self.lock(locked)
+        return cleared
+
+    def lock(self, games):
+        np = self.np
+        masks = self.masks[self.kind[games], self.rotation[games]] << self.x[games][:, None]
+        rows = self.y[games][:, None] + self.offsets
+        filled = masks != 0
+        self.boards[np.repeat(games, 4).reshape(-1, 4)[filled], rows[filled]] |= masks[filled]
+        boards = self.boards[games]
+        full = boards == self.full
+        cleared = full.sum(1)
+        clearing = cleared > 0
+        if clearing.any():
+            # Full rows sort to the top, keeping the order of the others, and are emptied there
+            order = np.argsort(~full[clearing], axis=1, kind="stable")
+            boards[clearing] = np.take_along_axis(boards[clearing], order, 1)
+            boards[np.arange(self.height) < cleared[:, None]] = 0
+            self.boards[games] = boards
+            self.lines[games] += cleared
+            self.score[games] += cleared * LINE_SCORE
+        self.spawn(games)
+        return cleared
+
+
+def benchmark_games(moves, seed):
+    game = Game(seed)
+    policy = random.Random(seed)
+    games, finished_score = 0, 0
+    start = time.perf_counter()
+    for _ in range(moves):
+        game.play(policy.randrange(6))
+        if game.over:
+            games += 1
+            finished_score += game.score
+            game = Game(policy.random())
+    return time.perf_counter() - start, games, finished_score
+
+
+def benchmark_batch(moves, count, seed):
+    batch = GameBatch(count, seed)
+    steps = max(1, moves // count)
+    start = time.perf_counter()
+    for _ in range(steps):
+        batch.step(batch.rng.integers(0, 6, count))
+    return time.perf_counter() - start, steps * count, batch.games, batch.finished_score
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the headless Tetris engine with a random policy")
+    parser.add_argument("--moves", type=int, default=200000, help="moves per mode")
+    parser.add_argument("--batch", type=int, default=4096, help="games stepped at once by the NumPy mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=("both", "scalar", "batch"), default="both")
+    parser.add_argument("--min-moves-per-second", type=float, help="exit with an error when a mode is slower")
+    parser.add_argument("--json", action="store_true", help="print the results as one JSON object")
+    args = parser.parse_args()
+
+    results = {}
+    if args.mode in ("both", "scalar"):
+        elapsed, games, score = benchmark_games(args.moves, args.seed)
+        results["scalar"] = {"moves": args.moves, "games": games, "seconds": elapsed, "finished_score": score}
+    if args.mode in ("both", "batch"):
+        if _numpy() is None:
+            if args.mode == "batch":
+                sys.exit("The batch mode needs NumPy")
+            print("NumPy is not installed, skipping the batch mode", file=sys.stderr)
+        else:
+            elapsed, moves, games, score = benchmark_batch(args.moves, args.batch, args.seed)
+            results["batch"] = {"moves": moves, "games": games, "seconds": elapsed, "finished_score": score}
+    for result in results.values():
+        result["moves_per_second"] = round(result["moves"] / result["seconds"])
+        result["games_per_second"] = round(result["games"] / result["seconds"], 1)
+        result["seconds"] = round(result["seconds"], 3)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for mode, result in results.items():
+            print(f"{mode}: {result['moves_per_second']} moves/s, {result['games_per_second']} games/s "
+                  f"({result['moves']} moves, {result['games']} games in {result['seconds']}s)")
+    slow = [mode for mode, result in results.items()
+            if args.min_moves_per_second and result["moves_per_second"] < args.min_moves_per_second]
+    if slow:
+        print(f"Below {args.min_moves_per_second:.0f} moves/s: {', '.join(slow)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
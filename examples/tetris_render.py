@@ -0,0 +1,185 @@
+import time
+
+import pygame
+
+from tetris_engine import GRID_HEIGHT, GRID_WIDTH, ROTATIONS
+
+# Drawing for tetris-game.py. The static parts (background, grid lines, borders) and one tile per color
+# are rendered once; every frame only the cells, texts and boxes that changed are blitted and passed to
+# pygame.display.update as dirty rectangles.
+
+SCREEN_WIDTH = 800
+SCREEN_HEIGHT = 600
+BLOCK_SIZE = 30
+GRID_OFFSET_X = (SCREEN_WIDTH - GRID_WIDTH * BLOCK_SIZE) // 2
+GRID_OFFSET_Y = SCREEN_HEIGHT - GRID_HEIGHT * BLOCK_SIZE - 20
+NEXT_BOX = pygame.Rect(SCREEN_WIDTH - 150, 100, 120, 120)
+# The I piece reaches past the right edge of the box
+NEXT_AREA = NEXT_BOX.union(pygame.Rect(NEXT_BOX.x + 10, NEXT_BOX.y + 10, 4 * BLOCK_SIZE, 2 * BLOCK_SIZE))
+
+# Colors
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+CYAN = (0, 255, 255)
+YELLOW = (255, 255, 0)
+MAGENTA = (255, 0, 255)
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+BLUE = (0, 0, 255)
+ORANGE = (255, 165, 0)
+
+COLORS = [CYAN, YELLOW, MAGENTA, GREEN, RED, BLUE, ORANGE]
+
+# Seconds between updates of the FPS/CPU overlay
+OVERLAY_INTERVAL = 0.5
+
+
+def cell_rect(x, y):
+    return pygame.Rect(GRID_OFFSET_X + x * BLOCK_SIZE, GRID_OFFSET_Y + y * BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE)
+
+
+def cells_under(rect):
+    # The grid cells that overlap a screen area; the top rows of the grid lie under the score and level
+    left = max((rect.left - GRID_OFFSET_X) // BLOCK_SIZE, 0)
+    right = min((rect.right - 1 - GRID_OFFSET_X) // BLOCK_SIZE, GRID_WIDTH - 1)
+    top = max((rect.top - GRID_OFFSET_Y) // BLOCK_SIZE, 0)
+    bottom = min((rect.bottom - 1 - GRID_OFFSET_Y) // BLOCK_SIZE, GRID_HEIGHT - 1)
+    return {(x, y) for y in range(top, bottom + 1) for x in range(left, right + 1)}
+
+
+class Renderer:
+    def __init__(self, screen, overlay=False):
+        self.screen = screen
+        self.overlay = overlay
+        self.fonts = {}
+        # key -> (text, surface, rect) of the text last rendered under that key
+        self.texts = {}
+        self.background = self._background()
+        # Settled cells keep the grid outline, the falling and next pieces are drawn without it
+        self.tiles = [self._tile(color, outline=True) for color in COLORS]
+        self.pieces = [self._tile(color) for color in COLORS]
+        self.board = None
+        self.piece = (None, frozenset())
+        self.next = None
+        self.dirty = []
+        self.frames = 0
+        self.sample_wall = time.perf_counter()
+        self.sample_cpu = time.process_time()
+
+    def _background(self):
+        background = pygame.Surface(self.screen.get_size()).convert()
+        background.fill(BLACK)
+        for y in range(GRID_HEIGHT):
+            for x in range(GRID_WIDTH):
+                pygame.draw.rect(background, WHITE, cell_rect(x, y), 1)
+        # The border sits just outside the cells, so that redrawing a cell never covers it
+        grid = pygame.Rect(GRID_OFFSET_X, GRID_OFFSET_Y, GRID_WIDTH * BLOCK_SIZE, GRID_HEIGHT * BLOCK_SIZE)
+        pygame.draw.rect(background, WHITE, grid.inflate(4, 4), 2)
+        pygame.draw.rect(background, WHITE, NEXT_BOX, 2)
+        return background
+
+    def _tile(self, color, outline=False):
+        tile = pygame.Surface((BLOCK_SIZE, BLOCK_SIZE)).convert()
+        tile.fill(color)
+        if outline:
+            pygame.draw.rect(tile, WHITE, tile.get_rect(), 1)
+        return tile
+
+    def font(self, size):
+        if size not in self.fonts:
+            self.fonts[size] = pygame.font.Font(None, size)
+        return self.fonts[size]
+
+    def text(self, key, text, size, **position):
+        # Renders the text only when it differs from the one last rendered under `key`, and returns the
+        # screen area to redraw (the old text's included), or None when it did not change. `position` is a
+        # pygame.Rect attribute, e.g. midtop=(x, y).
+        old = self.texts.get(key)
+        if old is not None and old[0] == text:
+            return None
+        surface = self.font(size).render(text, True, WHITE)
+        rect = surface.get_rect(**position)
+        self.texts[key] = (text, surface, rect)
+        return rect.union(old[2]) if old is not None else rect
+
+    def draw(self, game):
+        board = [bytes(row) for row in game.colors]
+        piece = (game.kind, frozenset((x, y) for x, y in game.cells() if y >= 0))
+        areas = {"score": self.text("score", f"Score: {game.score}", 30, midtop=(SCREEN_WIDTH // 2, 10)),
+                 "level": self.text("level", f"Level: {game.level}", 30, midtop=(SCREEN_WIDTH // 2, 50))}
+        if self.overlay:
+            areas["overlay"] = self._overlay()
+        areas = {key: area for key, area in areas.items() if area is not None}
+        if self.board is None:
+            self.screen.blit(self.background, (0, 0))
+            self.dirty.append(self.screen.get_rect())
+            cells = {(x, y) for y in range(GRID_HEIGHT) for x in range(GRID_WIDTH)}
+            areas = {key: rect for key, (_, _, rect) in self.texts.items()}
+        else:
+            cells = {(x, y) for y, row in enumerate(board) if row != self.board[y] for x in range(GRID_WIDTH)}
+            if piece != self.piece:
+                cells |= self.piece[1] | piece[1]
+            # Antialiased text cannot be blitted twice over itself, so a text with anything redrawn under it
+            # is redrawn whole, together with the cells it covers
+            for area in areas.values():
+                cells |= cells_under(area)
+            while True:
+                redrawn = [cell_rect(x, y) for x, y in cells] + list(areas.values())
+                touched = {key: rect for key, (_, _, rect) in self.texts.items()
+                           if key not in areas and rect.collidelist(redrawn) != -1}
+                if not touched:
+                    break
+                areas.update(touched)
+                for area in touched.values():
+                    cells |= cells_under(area)
+            for area in areas.values():
+                self.screen.blit(self.background, area, area)
+                self.dirty.append(area)
+        for x, y in cells:
+            rect = cell_rect(x, y)
+            self.screen.blit(self.background, rect, rect)
+            if (x, y) in piece[1]:
+                self.screen.blit(self.pieces[game.kind], rect)
+            elif board[y][x]:
+                self.screen.blit(self.tiles[board[y][x] - 1], rect)
+            self.dirty.append(rect)
+        for key in areas:
+            _, surface, rect = self.texts[key]
+            self.screen.blit(surface, rect)
+        self.board = board
+        self.piece = piece
+
+        if game.next != self.next:
+            self.next = game.next
+            self.screen.blit(self.background, NEXT_AREA, NEXT_AREA)
+            for y, mask in enumerate(ROTATIONS[game.next][0][0]):
+                for x in range(GRID_WIDTH):
+                    if mask >> x & 1:
+                        self.screen.blit(self.pieces[game.next], (NEXT_BOX.x + 10 + x * BLOCK_SIZE,
+                                                                  NEXT_BOX.y + 10 + y * BLOCK_SIZE))
+            self.dirty.append(NEXT_AREA)
+
+    def _overlay(self):
+        # Frames per second and the share of one core used by this process since the last update
+        self.frames += 1
+        wall = time.perf_counter()
+        if wall - self.sample_wall < OVERLAY_INTERVAL and "overlay" in self.texts:
+            return None
+        cpu = time.process_time()
+        elapsed = max(wall - self.sample_wall, 1e-6)
+        fps = self.frames / elapsed
+        self.frames = 0
+        self.sample_wall = wall
+        self.sample_cpu, cpu = cpu, (cpu - self.sample_cpu) / elapsed
+        return self.text("overlay", f"{fps:.0f} FPS  {cpu:.0%} CPU", 24, topleft=(10, 10))
+
+    def game_over(self):
+        area = self.text("game_over", "GAME OVER", 60, midtop=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
+        self.screen.blit(self.texts["game_over"][1], area)
+        self.dirty.append(area)
+        self.present()
+
+    def present(self):
+        if self.dirty:
+            pygame.display.update(self.dirty)
+            self.dirty = []